@@ -0,0 +1,65 @@
+# IMPORTS
+import os
+
+# CONFIG
+# bytes read per step when walking a log file backwards
+BLOCK_SIZE = 64 * 1024
+
+
+# returns the log file followed by its rotated files (lottery.log, lottery.log.1, lottery.log.2, ...), newest first
+def log_files(path):
+    files = [path]
+    while os.path.exists('%s.%d' % (path, len(files))):
+        files.append('%s.%d' % (path, len(files)))
+    return files
+
+
+# yields (offset, line) for every line of the file that starts before end, newest first, reading one block at a time
+def read_backwards(path, end=None):
+    if not os.path.exists(path):
+        return
+
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END) if end is None else end
+        partial = b''
+
+        while position > 0:
+            read_size = min(BLOCK_SIZE, position)
+            position -= read_size
+            f.seek(position)
+            lines = (f.read(read_size) + partial).split(b'\n')
+
+            # the first piece may continue in the previous block, keep it until that block has been read
+            line_end = position + sum(len(line) + 1 for line in lines) - 1
+            for line in reversed(lines[1:]):
+                line_end -= len(line)
+                if line:
+                    yield line_end, line
+                line_end -= 1
+            partial = lines[0]
+
+        if partial:
+            yield 0, partial
+
+
+# returns up to count log entries, newest first, and the cursor to read older entries from.
+# cursor is (file index, offset) as returned by the previous page; contains keeps only entries with that substring
+def read_log(path, count, cursor=None, contains=None):
+    files = log_files(path)
+    file_index, end = cursor or (0, None)
+    entries = []
+
+    while file_index < len(files):
+        for offset, line in read_backwards(files[file_index], end):
+            entry = line.decode('utf-8', 'replace').rstrip('\r')
+            if contains and contains not in entry:
+                continue
+
+            entries.append(entry)
+            if len(entries) == count:
+                return entries, (file_index, offset)
+
+        file_index += 1
+        end = None
+
+    return entries, None
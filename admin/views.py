@@ -1,14 +1,42 @@
 # IMPORTS
-import secrets
-from flask import Blueprint, render_template, flash, redirect, url_for
-from app import db, requires_roles
-from models import User, Draw, decrypt
+import secrets, time, json, hmac
+from datetime import datetime, timedelta
+from flask import Blueprint, render_template, flash, redirect, url_for, request, abort, jsonify, Response, \
+    send_from_directory
+from app import app, db, requires_roles, security_events, slow_request_profiler
+from models import User, Draw, LotteryJob
+from lottery.jobs import start_round_job
+from lottery.engine import UNPLAYED, round_winners
+from admin.log_reader import read_log
+from metrics import request_metrics
 from flask_login import current_user, login_required
+from sqlalchemy import func
 from sqlalchemy.orm import make_transient
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
 
+# columns shown by each admin user table, so the key BLOBs are never loaded
+USER_COLUMNS = (User.id, User.email, User.firstname, User.lastname, User.phone, User.dob, User.postcode, User.role)
+ACTIVITY_COLUMNS = (User.id, User.email, User.registered_on, User.current_login, User.ip_current, User.last_login,
+                    User.ip_last, User.successful_logins)
+
+# query string filters of the admin user tables: name -> (column, True for the start of a date range)
+USER_DATE_FILTERS = {'registered_from': (User.registered_on, True),
+                     'registered_to': (User.registered_on, False),
+                     'login_from': (User.current_login, True),
+                     'login_to': (User.current_login, False)}
+
+# total user counts per filter, reused for USER_COUNT_TTL seconds so paging does not count every row on each page
+user_counts = {}
+
+
+# the current winning draw, or only one that has not been played yet
+def winning_draw(unplayed=False):
+    if unplayed:
+        return Draw.query.filter_by(master_draw=True, been_played=False)
+    return Draw.query.filter_by(master_draw=True)
+
 
 # VIEWS
 # view admin homepage
@@ -26,11 +54,17 @@ def admin():
 def generate_winning_draw():
 
     # get current winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True).first()
+    current_winning_draw = winning_draw().first()
     lottery_round = 1
 
     # if a current winning draw exists
     if current_winning_draw:
+        # the winning draw of a round that is being played cannot be replaced
+        job = LotteryJob.query.filter_by(lottery_round=current_winning_draw.lottery_round).first()
+        if job and job.is_active():
+            flash("Round %d is being played. Wait for it to finish before adding a new winning draw." % job.lottery_round)
+            return redirect(url_for('admin.view_lottery_job', job_id=job.id))
+
         # update lottery round by 1
         lottery_round = current_winning_draw.lottery_round + 1
 
@@ -52,7 +86,7 @@ def generate_winning_draw():
     '''
 
     # create a new draw object.
-    new_winning_draw = Draw(user_id=current_user.id, numbers=winning_numbers_string, master_draw=True, lottery_round=lottery_round, public_key = current_user.public_key)
+    new_winning_draw = Draw(user_id=current_user.id, numbers=winning_numbers_string, master_draw=True, lottery_round=lottery_round, draw_key=current_user.get_draw_key())
 
     # add the new winning draw to the database
     db.session.add(new_winning_draw)
@@ -70,7 +104,7 @@ def generate_winning_draw():
 def view_winning_draw():
 
     # get winning draw from DB
-    current_winning_draw = Draw.query.filter_by(master_draw=True,been_played=False).first()
+    current_winning_draw = winning_draw(unplayed=True).first()
 
 
     # if a winning draw exists
@@ -81,8 +115,8 @@ def view_winning_draw():
         Commenting out Symmetric Encryption
         current_winning_draw.view_draw(current_user.draw_key)
         '''
-        # decrypt the winning draw
-        current_winning_draw.view_draw(current_user.private_key)
+        # decrypt the winning draw with the keys of the admin who generated it
+        current_winning_draw.view_draw(User.query.get(current_winning_draw.user_id))
         # re-render admin page with current winning draw and lottery round
         return render_template('admin/admin.html', winning_draw=current_winning_draw, name=current_user.firstname)
 
@@ -91,68 +125,121 @@ def view_winning_draw():
     return redirect(url_for('admin.admin'))
 
 
-# view lottery results and winners
+# start playing the current round in the background and show its progress
 @admin_blueprint.route('/run_lottery')
 @login_required
 @requires_roles('admin')
 def run_lottery():
 
     # get current unplayed winning draw
-    current_winning_draw = Draw.query.filter_by(master_draw=True, been_played=False).first()
+    current_winning_draw = winning_draw(unplayed=True).first()
 
     # if current unplayed winning draw exists
     if current_winning_draw:
 
-        # get all unplayed user draws
-        user_draws = Draw.query.filter_by(master_draw=False, been_played=False).all()
-        results = []
+        # if no unplayed user draws
+        if not Draw.query.filter(*UNPLAYED).first():
+            flash("No user draws entered.")
+            return admin()
 
-        # if at least one unplayed user draw exists
-        if user_draws:
+        # play all unplayed user draws against the winning draw, once per round however often this is requested
+        job = start_round_job(current_winning_draw)
+        return redirect(url_for('admin.view_lottery_job', job_id=job.id))
 
-            # update current winning draw as played
-            current_winning_draw.been_played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+    # if current unplayed winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return redirect(url_for('admin.admin'))
 
-            # for each unplayed user draw
-            for draw in user_draws:
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
-                draw.numbers = decrypt(draw.numbers, user.private_key)
-                current_winning_draw.numbers = decrypt(current_winning_draw.numbers, current_user.private_key)
-                # if user draw matches current unplayed winning draw
-                if draw.numbers == current_winning_draw.numbers:
 
-                    # add details of winner to list of results
-                    results.append((current_winning_draw.lottery_round, draw.numbers, draw.user_id, user.email))
+# view the progress of a lottery round job, and its winners once finished
+@admin_blueprint.route('/lottery_jobs/<int:job_id>')
+@login_required
+@requires_roles('admin')
+def view_lottery_job(job_id):
+    job = db.get_or_404(LotteryJob, job_id)
+    progress = job.progress()
+
+    results = next_after = None
+    if job.status == 'finished':
+        progress['tiers'] = json.loads(job.result)['tiers']
+        results, next_after = round_winners(job.lottery_round, request.args.get('after', 0, type=int),
+                                            app.config['ADMIN_PAGE_SIZE'])
+
+        # if no winners
+        if not job.winners:
+            flash("No winners.")
+        # the round was played but its draws were not archived, they are archived with the next round
+        if job.error:
+            flash("Round %d was played, but archiving its draws failed: %s" % (job.lottery_round, job.error))
+    elif progress['status'] == 'failed':
+        flash("Round %d failed. Run the lottery again to retry it." % job.lottery_round)
+    elif job.status == 'empty':
+        flash("No user draws entered.")
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    draw.matches_master = True
+    return render_template('admin/admin.html', results=results, lottery_job=progress, next_after=next_after,
+                           name=current_user.firstname)
 
-                # update draw as played
-                draw.been_played = True
 
-                # update draw with current lottery round
-                draw.lottery_round = current_winning_draw.lottery_round
+# progress of a lottery round job as JSON, polled by the job page
+@admin_blueprint.route('/lottery_jobs/<int:job_id>/progress')
+@login_required
+@requires_roles('admin')
+def lottery_job_progress(job_id):
+    return jsonify(db.get_or_404(LotteryJob, job_id).progress())
 
-                # commit draw changes to DB
-                db.session.add(draw)
-                db.session.commit()
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
+# returns the user table filters given in the query string
+def user_filters():
+    return {name: request.args[name] for name in ('email', *USER_DATE_FILTERS) if request.args.get(name)}
 
-            return render_template('admin/admin.html', results=results, name=current_user.firstname)
 
-        flash("No user draws entered.")
-        return admin()
+# applies the filters to a query over users
+def filter_users(query, filters):
+    query = query.filter(User.role == 'user')
 
-    # if current unplayed winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
-    return redirect(url_for('admin.admin'))
+    # email prefix as a range so the unique email index is used (LIKE is case-insensitive in sqlite and cannot be)
+    if 'email' in filters:
+        query = query.filter(User.email >= filters['email'], User.email < filters['email'] + '\uffff')
+
+    # dates are YYYY-MM-DD, both ends of a range are inclusive
+    for name, (column, range_start) in USER_DATE_FILTERS.items():
+        if name in filters:
+            try:
+                date = datetime.strptime(filters[name], '%Y-%m-%d')
+            except ValueError:
+                abort(400)
+            query = query.filter(column >= date if range_start else column < date + timedelta(days=1))
+
+    return query
+
+
+# returns the total number of users matching the filters, counted at most once every USER_COUNT_TTL seconds
+def count_users(query, filters):
+    cache_key = tuple(sorted(filters.items()))
+    cached = user_counts.get(cache_key)
+    if cached and time.monotonic() - cached[0] < app.config['USER_COUNT_TTL']:
+        return cached[1]
+
+    total = query.with_entities(func.count(User.id)).scalar()
+    if len(user_counts) > 1000:
+        user_counts.clear()
+    user_counts[cache_key] = (time.monotonic(), total)
+    return total
+
+
+# returns one keyset page of users after the id in the query string, the total and the id the next page starts after
+def user_page(columns, filters):
+    query = filter_users(db.session.query(*columns), filters)
+    total = count_users(query, filters)
+    page_size = app.config['ADMIN_PAGE_SIZE']
+
+    users = query.filter(User.id > request.args.get('after', 0, type=int)) \
+        .order_by(User.id) \
+        .limit(page_size + 1) \
+        .all()
+    next_after = users[page_size - 1].id if len(users) > page_size else None
+
+    return users[:page_size], total, next_after
 
 
 # view all registered users
@@ -160,21 +247,104 @@ def run_lottery():
 @login_required
 @requires_roles('admin')
 def view_all_users():
-    current_users = User.query.filter_by(role='user').all()
+    filters = user_filters()
+    current_users, total, next_after = user_page(USER_COLUMNS, filters)
 
-    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users)
+    return render_template('admin/admin.html', name=current_user.firstname, current_users=current_users,
+                           users_total=total, next_after=next_after, filters=filters)
 
 
-# view last 10 log entries
+# view the latest log entries, optionally only those containing a search string, and page further back
 @admin_blueprint.route('/logs')
 @login_required
 @requires_roles('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    search = request.args.get('search', '')
+
+    # cursor of the previous page as 'file index:offset'
+    cursor = None
+    if request.args.get('before'):
+        try:
+            cursor = tuple(int(part) for part in request.args['before'].split(':'))
+        except ValueError:
+            abort(400)
+        if len(cursor) != 2:
+            abort(400)
+
+    content, cursor = read_log(app.config['LOG_FILE'], app.config['LOG_PAGE_SIZE'], cursor, search)
+    before = '%d:%d' % cursor if cursor else None
+
+    return render_template('admin/admin.html', logs=content, log_search=search, log_before=before,
+                           name=current_user.firstname)
+
+
+# view security event counts by type, IP and hour, and the latest matching events
+@admin_blueprint.route('/security_events')
+@login_required
+@requires_roles('admin')
+def view_security_events():
+    hours = request.args.get('hours', 24, type=int)
+    event_type = request.args.get('type', '')
+    ip = request.args.get('ip', '')
+    since = time.time() - hours * 3600
+
+    event_buckets = [(datetime.fromtimestamp(bucket).strftime('%d/%m/%Y %H:00'), bucket_type, count)
+                     for bucket, bucket_type, count in security_events.counts_by_bucket(since)]
+
+    return render_template('admin/admin.html', name=current_user.firstname,
+                           event_filters={'hours': hours, 'type': event_type, 'ip': ip},
+                           event_counts=security_events.counts_by_type(since),
+                           event_ips=security_events.counts_by_ip(since, event_type or 'Failed Login'),
+                           event_buckets=event_buckets,
+                           events=[(datetime.fromtimestamp(created).strftime('%d/%m/%Y %H:%M:%S'), *event)
+                                   for created, *event in security_events.events(since, event_type, ip)])
+
+
+# view per-endpoint request metrics
+@admin_blueprint.route('/metrics')
+@login_required
+@requires_roles('admin')
+def view_metrics():
+    return render_template('admin/admin.html', name=current_user.firstname,
+                           metrics=sorted(request_metrics.stats().items()),
+                           components=request_metrics.component_stats())
+
 
-    return render_template('admin/admin.html', logs=content, name=current_user.firstname)
+@login_required
+@requires_roles('admin')
+def admin_prometheus_metrics():
+    return Response(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+# request metrics in the Prometheus text format, for admins or for scrapers sending the METRICS_TOKEN bearer token
+@admin_blueprint.route('/metrics/prometheus')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+        return Response(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+    return admin_prometheus_metrics()
+
+
+# view the stack profiles of slow requests, newest first
+@admin_blueprint.route('/profiles')
+@login_required
+@requires_roles('admin')
+def view_profiles():
+    profiles = [dict(profile, started=datetime.fromtimestamp(profile['started']).strftime('%d/%m/%Y %H:%M:%S'))
+                for profile in slow_request_profiler.profiles()]
+    return render_template('admin/admin.html', name=current_user.firstname, profiles=profiles, profiles_viewed=True,
+                           profiler_enabled=app.config['PROFILER_ENABLED'],
+                           profiler_threshold=app.config['PROFILER_THRESHOLD_MS'])
+
+
+# download a slow request profile as collapsed stacks, for flamegraph.pl or speedscope
+@admin_blueprint.route('/profiles/<name>')
+@login_required
+@requires_roles('admin')
+def download_profile(name):
+    if name not in {profile['name'] for profile in slow_request_profiler.profiles()}:
+        abort(404)
+    return send_from_directory(app.config['PROFILER_DIR'], name, mimetype='text/plain', as_attachment=True)
 
 
 # view user activity
@@ -182,6 +352,8 @@ def logs():
 @login_required
 @requires_roles('admin')
 def view_user_activity():
-    current_users = User.query.filter_by(role='user').all()
+    filters = user_filters()
+    current_users, total, next_after = user_page(ACTIVITY_COLUMNS, filters)
 
-    return render_template('admin/admin.html', name=current_user.firstname, activity=current_users)
+    return render_template('admin/admin.html', name=current_user.firstname, activity=current_users,
+                           users_total=total, next_after=next_after, filters=filters)
@@ -6,7 +6,13 @@ from flask_login import LoginManager, current_user
 from functools import wraps
 from flask_talisman import Talisman
 from dotenv import load_dotenv
-import logging, os
+from security_log import SecurityFilter, DroppingQueueHandler, SecurityLogWriter, SecurityEventStore, security_event
+from rate_limit import SlidingWindowLimiter
+from metrics import request_metrics
+from profiler import SlowRequestProfiler
+from sqlalchemy import event
+from werkzeug.middleware.proxy_fix import ProxyFix
+import logging, os, queue, atexit, time
 
 # CONFIG
 load_dotenv()
@@ -17,6 +23,54 @@ app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS')
 app.config['RECAPTCHA_PUBLIC_KEY'] = os.getenv('RECAPTCHA_PUBLIC_KEY')
 app.config['RECAPTCHA_PRIVATE_KEY'] = os.getenv('RECAPTCHA_PRIVATE_KEY')
+app.config['KEY_CACHE_SIZE'] = int(os.getenv('KEY_CACHE_SIZE', 1024))
+# seconds a user's identity is cached per process: a change is dropped from the cache of the process that commits it,
+# other processes can serve the old identity (e.g. a revoked role) until it expires
+app.config['IDENTITY_CACHE_TTL'] = int(os.getenv('IDENTITY_CACHE_TTL', 30))
+app.config['IDENTITY_CACHE_SIZE'] = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+app.config['BLIND_INDEX_KEY'] = os.getenv('BLIND_INDEX_KEY', app.config['SECRET_KEY'])
+app.config['LOTTERY_PRIZE_TIERS'] = sorted(int(tier) for tier in os.getenv('LOTTERY_PRIZE_TIERS', '3,4,5,6').split(','))
+app.config['LOTTERY_WORKERS'] = int(os.getenv('LOTTERY_WORKERS', 1))
+app.config['LOTTERY_JOB_TIMEOUT'] = int(os.getenv('LOTTERY_JOB_TIMEOUT', 600))
+app.config['LOTTERY_CHUNK_SIZE'] = int(os.getenv('LOTTERY_CHUNK_SIZE', 5000))
+app.config['ARCHIVE_CHUNK_SIZE'] = int(os.getenv('ARCHIVE_CHUNK_SIZE', 1000))
+app.config['ARCHIVE_PAUSE'] = float(os.getenv('ARCHIVE_PAUSE', 0.05))
+app.config['ARCHIVE_RETENTION_ROUNDS'] = int(os.getenv('ARCHIVE_RETENTION_ROUNDS', 0))
+# key pairs kept ready per process for registrations: a burst that outruns the refill by more than KEY_POOL_SIZE
+# registrations generates the rest inline, at about the key_pool refill_rate reported in the metrics
+app.config['KEY_POOL_SIZE'] = int(os.getenv('KEY_POOL_SIZE', 64))
+app.config['KEY_POOL_LOW_WATER'] = int(os.getenv('KEY_POOL_LOW_WATER', 16))
+app.config['KEY_POOL_WORKERS'] = int(os.getenv('KEY_POOL_WORKERS', 1))
+app.config['BCRYPT_ROUNDS'] = int(os.getenv('BCRYPT_ROUNDS', 12))
+app.config['HASH_WORKERS'] = int(os.getenv('HASH_WORKERS', os.cpu_count() or 1))
+app.config['HASH_QUEUE_SIZE'] = int(os.getenv('HASH_QUEUE_SIZE', 16))
+app.config['MAX_DRAWS_PER_REQUEST'] = int(os.getenv('MAX_DRAWS_PER_REQUEST', 100))
+app.config['ADMIN_PAGE_SIZE'] = int(os.getenv('ADMIN_PAGE_SIZE', 50))
+app.config['USER_COUNT_TTL'] = int(os.getenv('USER_COUNT_TTL', 60))
+app.config['LOG_FILE'] = os.getenv('LOG_FILE', 'lottery.log')
+app.config['LOG_PAGE_SIZE'] = int(os.getenv('LOG_PAGE_SIZE', 10))
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+app.config['LOG_BATCH_SIZE'] = int(os.getenv('LOG_BATCH_SIZE', 100))
+app.config['SECURITY_EVENTS_DB'] = os.getenv('SECURITY_EVENTS_DB', os.path.join(app.instance_path, 'security_events.db'))
+app.config['RATE_LIMIT_DB'] = os.getenv('RATE_LIMIT_DB', os.path.join(app.instance_path, 'rate_limit.db'))
+app.config['LOGIN_LIMIT_WINDOW'] = int(os.getenv('LOGIN_LIMIT_WINDOW', 300))
+app.config['LOGIN_LIMIT_PER_IP'] = int(os.getenv('LOGIN_LIMIT_PER_IP', 30))
+app.config['LOGIN_LIMIT_PER_EMAIL'] = int(os.getenv('LOGIN_LIMIT_PER_EMAIL', 10))
+app.config['LOGIN_LIMIT_PRUNE_EVERY'] = int(os.getenv('LOGIN_LIMIT_PRUNE_EVERY', 1000))
+# reverse proxies in front of the app: the client address and scheme are taken from the X-Forwarded-For and
+# X-Forwarded-Proto headers they set, so per-IP login limits and security events see the client rather than the proxy.
+# Leave at 0 when clients connect directly, the headers could be forged
+app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+app.config['PROFILER_ENABLED'] = os.getenv('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['PROFILER_THRESHOLD_MS'] = int(os.getenv('PROFILER_THRESHOLD_MS', 1000))
+app.config['PROFILER_INTERVAL_MS'] = int(os.getenv('PROFILER_INTERVAL_MS', 10))
+app.config['PROFILER_DIR'] = os.getenv('PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILER_MAX_FILES'] = int(os.getenv('PROFILER_MAX_FILES', 50))
+
+# take the client address and scheme from the headers of the trusted proxies
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
 
 # only allows permitted roles to access certain webpages/methods
 def requires_roles(*roles):
@@ -28,7 +82,9 @@ def requires_roles(*roles):
                                 current_user.id,
                                 current_user.email,
                                 current_user.role,
-                                request.remote_addr)
+                                request.remote_addr,
+                                extra=security_event('Unauthorised Access Denied', current_user.id,
+                                                     current_user.email, request.remote_addr))
                 
                 return forbidden(403)
             return f(*args, **kwargs)
@@ -64,22 +120,50 @@ db = SQLAlchemy(app)
 talisman = Talisman(app, content_security_policy=csp)
 qrcode = QRcode(app)
 
-# initialise logger and file handler
+# initialise logger and queue-backed security log: requests only put security records on a bounded queue and a
+# background thread writes them to the log file in batches
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('lottery.log', 'a')
-file_handler.setLevel(logging.WARNING)
-
-# filter for logs that include the string 'SECURITY'
-class SecurityFilter(logging.Filter):
-    
-    def filter(self, record):
-        return 'SECURITY' in record.getMessage()
-    
-file_handler.addFilter(SecurityFilter())
+logger.setLevel(logging.WARNING)
+security_records = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+
+queue_handler = DroppingQueueHandler(security_records)
+queue_handler.setLevel(logging.WARNING)
+queue_handler.addFilter(SecurityFilter())
+logger.addHandler(queue_handler)
+
+# structured security events for the admin security event views
+os.makedirs(os.path.dirname(app.config['SECURITY_EVENTS_DB']) or '.', exist_ok=True)
+security_events = SecurityEventStore(app.config['SECURITY_EVENTS_DB'])
+
 formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+security_log_writer = SecurityLogWriter(security_records, app.config['LOG_FILE'], formatter, app.config['LOG_BATCH_SIZE'],
+                                        security_events)
+security_log_writer.start()
+
+# write out everything still queued when the process exits
+atexit.register(security_log_writer.stop)
+
+# errors are not security records and never reach the log file, so they go to stderr with their traceback, e.g. a
+# failed lottery round job
+error_handler = logging.StreamHandler()
+error_handler.setLevel(logging.ERROR)
+error_handler.setFormatter(formatter)
+logger.addHandler(error_handler)
+
+# sliding-window limits on login attempts per IP and per email, shared by all worker processes on this host
+os.makedirs(os.path.dirname(app.config['RATE_LIMIT_DB']) or '.', exist_ok=True)
+login_limiter = SlidingWindowLimiter(app.config['RATE_LIMIT_DB'], app.config['LOGIN_LIMIT_WINDOW'],
+                                     app.config['LOGIN_LIMIT_PRUNE_EVERY'])
+
+# report the security log queue and the login limits with the request metrics
+request_metrics.register('security_log', lambda: dict(security_log_writer.stats(), queued=security_records.qsize(),
+                                                      dropped=queue_handler.dropped),
+                         counters=('dropped', 'written', 'batches', 'write_errors', 'store_errors', 'events_dropped'))
+request_metrics.register('login_limiter', login_limiter.stats, counters=('admitted', 'rejected'))
+
+# stack profiles of requests slower than PROFILER_THRESHOLD_MS, only sampled when PROFILER_ENABLED is set
+slow_request_profiler = SlowRequestProfiler(app.config['PROFILER_DIR'], app.config['PROFILER_THRESHOLD_MS'] / 1000,
+                                            app.config['PROFILER_INTERVAL_MS'] / 1000, app.config['PROFILER_MAX_FILES'])
 
 # initialise login manager
 login_manager = LoginManager()
@@ -89,7 +173,37 @@ login_manager.init_app(app)
 @login_manager.user_loader
 def load_user(id):
     from models import User
-    return User.query.get(int(id))
+    return User.load_identity(int(id))
+
+# record latency, SQL statements and crypto and bcrypt time of every request, per endpoint
+@app.before_request
+def start_request_metrics():
+    request_metrics.start()
+
+@app.after_request
+def finish_request_metrics(response):
+    request_metrics.finish(request.endpoint or 'unmatched', response.status_code)
+    return response
+
+# profile requests that run past the threshold, including those ending in an unhandled exception
+@app.before_request
+def start_request_profile():
+    if app.config['PROFILER_ENABLED']:
+        slow_request_profiler.start(request.endpoint or 'unmatched')
+
+@app.teardown_request
+def finish_request_profile(error):
+    if app.config['PROFILER_ENABLED']:
+        slow_request_profiler.finish()
+
+with app.app_context():
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(db.engine, 'after_cursor_execute')
+    def record_query_time(connection, cursor, statement, parameters, context, executemany):
+        request_metrics.query(time.perf_counter() - connection.info['query_start'].pop())
 
 # HOME PAGE VIEW
 @app.route('/')
@@ -108,6 +222,11 @@ app.register_blueprint(users_blueprint)
 app.register_blueprint(admin_blueprint)
 app.register_blueprint(lottery_blueprint)
 
+# register database maintenance commands with the flask cli
+from migrations import COMMANDS
+for command in COMMANDS:
+    app.cli.add_command(command)
+
 
 # ERROR HANDLING
 @app.errorhandler(400)
@@ -125,6 +244,11 @@ def not_found(error):
      return render_template('errors/error.html', error="404 Not Found", text="The server cannot find the requested resource.",
                            link="https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/404"), 404
 
+@app.errorhandler(429)
+def too_many_requests(error):
+    return render_template('errors/error.html', error="429 Too Many Requests", text="The user has sent too many requests in a given amount of time.",
+                           link="https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/429"), 429
+
 @app.errorhandler(500)
 def internal_server_error(error):
     return render_template('errors/error.html', error="500 Internal Server Error", text="The server has encountered a situation it does not know how to handle.",
@@ -0,0 +1,70 @@
+# IMPORTS
+import argparse, os, random, tempfile, time
+
+# benchmarks run against a throwaway database, never the application's own
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+
+from app import app, db
+from models import User, Draw, LotteryJob, init_db
+from lottery.engine import run_round
+from migrations import backfill_blind_index
+from sqlalchemy import update
+
+
+# creates users with random draws and a winning draw for round 1
+def seed(users, tickets):
+    init_db()
+    with app.app_context():
+        admin = User.query.filter_by(role='admin').first()
+        players = [User(email='player%d@email.com' % i, firstname='Player', lastname='Test', phone='0191-123-4567',
+                        dob='01/01/1999', postcode='NE1 2AB', password='Player1!', role='user')
+                   for i in range(users)]
+        db.session.add_all(players)
+        db.session.commit()
+
+        for player in players:
+            draw_key = player.get_draw_key()
+            db.session.add_all(Draw(user_id=player.id, numbers=' '.join(map(str, sorted(random.sample(range(1, 61), 6)))),
+                                    master_draw=False, lottery_round=0, draw_key=draw_key)
+                               for i in range(tickets))
+        db.session.add(Draw(user_id=admin.id, numbers=' '.join(map(str, sorted(random.sample(range(1, 61), 6)))),
+                            master_draw=True, lottery_round=1, draw_key=admin.get_draw_key()))
+        db.session.commit()
+
+
+# plays the round, then resets it so the same draws can be played again
+def time_round(drop_index):
+    with app.app_context():
+        reset = update(Draw).values(been_played=False, matches_master=False, matches=0, lottery_round=0)
+        if drop_index:
+            # draws without a blind index fall back to the decrypt-everything path
+            reset = reset.values(blind_index=None)
+        db.session.execute(reset)
+        LotteryJob.query.delete()
+        db.session.commit()
+
+        start = time.perf_counter()
+        round_result = run_round(Draw.query.filter_by(master_draw=True).first())
+        return time.perf_counter() - start, round_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare lottery round time with and without the blind index.')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tickets', type=int, default=500, help='draws per user')
+    args = parser.parse_args()
+
+    # the blind index is only used when the jackpot is the sole prize tier
+    app.config['LOTTERY_PRIZE_TIERS'] = [6]
+    seed(args.users, args.tickets)
+    for name, drop_index in (('decrypt every draw', True), ('blind index lookup', False)):
+        if not drop_index:
+            backfill_blind_index()
+        elapsed, round_result = time_round(drop_index)
+        print('%-20s %8.3fs  %d draws, %d decrypted, %d winners'
+              % (name, elapsed, round_result.tickets, round_result.decrypted, round_result.winners))
+
+
+if __name__ == '__main__':
+    main()
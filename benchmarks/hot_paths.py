@@ -0,0 +1,148 @@
+# IMPORTS
+import argparse, json, platform, random, re, sys, time
+from datetime import datetime
+from benchmarks.population import app, db, seed, add_tickets, random_numbers, PASSWORD, POSTCODE
+from models import User
+import pyotp
+
+# CONFIG
+ADMIN_EMAIL = 'admin@email.com'
+ADMIN_PASSWORD = 'Admin1!'
+
+
+# summary of a list of latencies in seconds, reported in milliseconds
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))] * 1000
+
+    return {'count': len(samples),
+            'mean_ms': sum(samples) / len(samples) * 1000,
+            'min_ms': samples[0] * 1000,
+            'p50_ms': percentile(50),
+            'p90_ms': percentile(90),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': samples[-1] * 1000}
+
+
+# test client of one browser session: https (Talisman redirects plain http) and the session's CSRF token on every POST
+class Browser:
+
+    def __init__(self):
+        self.client = app.test_client()
+        self.client.environ_base['HTTP_X_FORWARDED_PROTO'] = 'https'
+        page = self.client.get('/login').get_data(as_text=True)
+        self.csrf_token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+
+    def get(self, url):
+        return self.client.get(url)
+
+    def post(self, url, data=None):
+        return self.client.post(url, data=dict(data or {}, csrf_token=self.csrf_token))
+
+    def login(self, email, password, pin_key):
+        return self.post('/login', {'email': email, 'password': password, 'postcode': POSTCODE,
+                                    'pin': pyotp.TOTP(pin_key).now()})
+
+
+# times `iterations` calls of request(*prepare()), only the request itself is timed. Responses for which succeeded()
+# is False, by default 4xx and 5xx responses, are counted as errors
+def time_path(iterations, request, prepare=tuple, succeeded=lambda response: response.status_code < 400):
+    samples = []
+    errors = 0
+    for i in range(iterations):
+        args = prepare()
+        start = time.perf_counter()
+        response = request(*args)
+        samples.append(time.perf_counter() - start)
+        if not succeeded(response):
+            errors += 1
+    return dict(percentiles(samples), errors=errors)
+
+
+# plays a round through /run_lottery and waits until its background job has finished
+def play_round(admin):
+    response = admin.get('/run_lottery')
+    if response.status_code != 302 or '/lottery_jobs/' not in response.location:
+        return response
+
+    while True:
+        progress = admin.get(response.location + '/progress')
+        if progress.get_json()['status'] not in ('queued', 'running'):
+            return progress
+        time.sleep(0.01)
+
+
+def run(users, tickets, iterations, rounds):
+    app.config['TESTING'] = True
+    emails = seed(users, tickets)
+    with app.app_context():
+        pin_keys = dict(db.session.query(User.email, User.pin_key))
+
+    results = {}
+
+    # each login runs in a fresh session, the login page itself is not timed
+    def new_login():
+        email = random.choice(emails)
+        return Browser(), email, PASSWORD, pin_keys[email]
+    results['login'] = time_path(iterations, Browser.login, new_login)
+
+    player = Browser()
+    email = random.choice(emails)
+    player.login(email, PASSWORD, pin_keys[email])
+
+    def create_draw():
+        numbers = random_numbers().split()
+        return player.post('/create_draw', {'number%d' % (i + 1): number for i, number in enumerate(numbers)})
+    results['create_draw'] = time_path(iterations, create_draw)
+    results['view_draws'] = time_path(iterations, lambda: player.post('/view_draws'))
+
+    # every round after the first is played against freshly added tickets
+    admin = Browser()
+    admin.login(ADMIN_EMAIL, ADMIN_PASSWORD, pin_keys[ADMIN_EMAIL])
+    rounds_played = []
+
+    def new_round():
+        if rounds_played:
+            add_tickets(tickets)
+        rounds_played.append(admin.get('/generate_winning_draw'))
+        return admin,
+    results['run_lottery'] = time_path(rounds, play_round, new_round,
+                                       lambda response: response.is_json and response.get_json()['status'] == 'finished')
+
+    results['check_draws'] = time_path(iterations, lambda: player.post('/check_draws'))
+
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'config': {'users': users, 'tickets': tickets, 'iterations': iterations, 'rounds': rounds,
+                       'bcrypt_rounds': app.config['BCRYPT_ROUNDS'],
+                       'lottery_workers': app.config['LOTTERY_WORKERS'],
+                       'lottery_chunk_size': app.config['LOTTERY_CHUNK_SIZE']},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the hot paths of the app against a generated population.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--tickets', type=int, default=20, help='unplayed draws per user')
+    parser.add_argument('--iterations', type=int, default=50, help='requests timed per path')
+    parser.add_argument('--rounds', type=int, default=3, help='lottery rounds timed')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = run(args.users, args.tickets, args.iterations, args.rounds)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
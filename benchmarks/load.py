@@ -0,0 +1,262 @@
+# IMPORTS
+import argparse, json, logging, re, sys, threading, time, uuid
+import urllib.error, urllib.parse, urllib.request
+from datetime import datetime
+from http.cookiejar import CookieJar
+from benchmarks.population import app, db, random_numbers, POSTCODE
+from benchmarks.hot_paths import percentiles, ADMIN_EMAIL, ADMIN_PASSWORD
+from app import talisman
+from models import User, LotteryJob, init_db
+from flask import got_request_exception
+from sqlalchemy.exc import OperationalError
+from werkzeug.serving import make_server
+import pyotp
+
+# CONFIG
+# password of every registered player
+PASSWORD = 'Player1!'
+# seconds a single request may take before it counts as an error
+REQUEST_TIMEOUT = 60
+
+
+# latencies, errors and sqlite lock timeouts of every request made during a run, shared by all journeys
+class Recorder:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.lock_timeouts = 0
+        self.journeys = 0
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            self.errors[name] = self.errors.get(name, 0) + (not ok)
+
+    # counts requests that failed because sqlite could not get its lock in time
+    def request_exception(self, sender, exception, **extra):
+        if isinstance(exception, OperationalError) and 'locked' in str(exception):
+            with self.lock:
+                self.lock_timeouts += 1
+
+
+# returns redirects as responses instead of following them
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# one player or admin talking to the server over HTTP with their own cookies and CSRF token
+class Browser:
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect())
+        self.csrf_token = None
+
+    # makes a timed request and returns (status, location, body); status 0 when no response came back
+    def request(self, name, path, data=None, expected=(200, 302)):
+        if data is not None:
+            data = urllib.parse.urlencode(dict(data, csrf_token=self.csrf_token)).encode()
+        # the app forces https, the harness server sits behind an imaginary TLS proxy
+        request = urllib.request.Request(self.base_url + path, data=data, headers={'X-Forwarded-Proto': 'https'})
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                status, location, body = response.status, response.headers.get('Location'), response.read()
+        except urllib.error.HTTPError as error:
+            status, location, body = error.code, error.headers.get('Location'), error.read()
+        except OSError:
+            status, location, body = 0, None, b''
+        self.recorder.record(name, time.perf_counter() - start, status in expected)
+
+        token = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', body)
+        if token:
+            self.csrf_token = token.group(1).decode()
+        return status, location, body
+
+    def login(self, email, password, pin_key):
+        self.request('login page', '/login')
+        return self.request('login', '/login', {'email': email, 'password': password, 'postcode': POSTCODE,
+                                                'pin': pyotp.TOTP(pin_key).now()}, expected=(302,))
+
+
+# register -> 2FA setup -> login -> buy tickets -> view draws -> check results -> logout
+def player_journey(base_url, recorder, tickets):
+    browser = Browser(base_url, recorder)
+    email = 'load-%s@email.com' % uuid.uuid4().hex[:12]
+
+    browser.request('register page', '/register')
+    status, location, body = browser.request('register', '/register', {
+        'email': email, 'firstname': 'Load', 'lastname': 'Player', 'phone': '0191-123-4567', 'dob': '01/01/1999',
+        'postcode': POSTCODE, 'password': PASSWORD, 'confirm_password': PASSWORD}, expected=(302,))
+    if status != 302:
+        return
+    browser.request('setup_2fa', '/setup_2fa')
+
+    # stands in for the authenticator app scanning the QR code
+    with app.app_context():
+        pin_key = db.session.query(User.pin_key).filter(User.email == email).scalar()
+
+    if browser.login(email, PASSWORD, pin_key)[0] != 302:
+        return
+    for i in range(tickets):
+        browser.request('create_draw', '/create_draw',
+                        {'number%d' % (n + 1): number for n, number in enumerate(random_numbers().split())})
+    browser.request('view_draws', '/view_draws', {})
+    browser.request('check_draws', '/check_draws', {})
+    browser.request('logout', '/logout')
+
+    with recorder.lock:
+        recorder.journeys += 1
+
+
+# generates a winning draw and plays the round until it has finished, every `interval` seconds until stopped
+def admin_journey(base_url, recorder, interval, stop):
+    browser = Browser(base_url, recorder)
+    with app.app_context():
+        pin_key = db.session.query(User.pin_key).filter(User.email == ADMIN_EMAIL).scalar()
+    browser.login(ADMIN_EMAIL, ADMIN_PASSWORD, pin_key)
+
+    while not stop.wait(interval):
+        browser.request('generate_winning_draw', '/generate_winning_draw', expected=(302,))
+
+        start = time.perf_counter()
+        status, location, body = browser.request('run_lottery', '/run_lottery')
+        # a 200 means there were no tickets to play yet
+        if status != 302 or '/lottery_jobs/' not in (location or ''):
+            continue
+        path = urllib.parse.urlparse(location).path
+
+        while True:
+            status, _, body = browser.request('lottery_job progress', path + '/progress', expected=(200,))
+            job = json.loads(body) if status == 200 else {'status': 'failed'}
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.05)
+        recorder.record('round', time.perf_counter() - start, job['status'] in ('finished', 'empty'))
+
+        with recorder.lock:
+            recorder.journeys += 1
+
+
+# runs `players` concurrent player journeys, one after another per player, and `admins` admins playing rounds, for
+# `duration` seconds against a server started in this process, and returns the report
+def run(players, admins, duration, tickets, admin_interval):
+    app.config['TESTING'] = True
+    # the server speaks plain http, so the session cookie must not be https only
+    talisman.session_cookie_secure = False
+    init_db()
+
+    recorder = Recorder()
+    got_request_exception.connect(recorder.request_exception, app)
+
+    # one access log line per request would drown the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='load-server', daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    stop = threading.Event()
+
+    def player():
+        while not stop.is_set():
+            player_journey(base_url, recorder, tickets)
+
+    threads = [threading.Thread(target=player, name='player-%d' % i) for i in range(players)] + \
+              [threading.Thread(target=admin_journey, args=(base_url, recorder, admin_interval, stop),
+                                name='admin-%d' % i) for i in range(admins)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    got_request_exception.disconnect(recorder.request_exception, app)
+
+    # background rounds that failed on a lock count as lock timeouts too
+    with app.app_context():
+        failed_rounds = LotteryJob.query.filter(LotteryJob.error.like('%locked%')).count()
+
+    requests = sum(len(samples) for samples in recorder.samples.values())
+    errors = sum(recorder.errors.values())
+    lock_timeouts = recorder.lock_timeouts + failed_rounds
+    return {'created': datetime.now().isoformat(timespec='seconds'),
+            'config': {'players': players, 'admins': admins, 'duration': duration, 'tickets': tickets,
+                       'admin_interval': admin_interval, 'bcrypt_rounds': app.config['BCRYPT_ROUNDS']},
+            'elapsed_s': elapsed,
+            'requests': requests,
+            'journeys': recorder.journeys,
+            'throughput_rps': requests / elapsed,
+            'journeys_per_s': recorder.journeys / elapsed,
+            'errors': errors,
+            'error_rate': errors / requests if requests else 0.0,
+            'lock_timeouts': lock_timeouts,
+            'lock_timeout_rate': lock_timeouts / requests if requests else 0.0,
+            'endpoints': {name: dict(percentiles(samples), errors=recorder.errors[name])
+                          for name, samples in sorted(recorder.samples.items())}}
+
+
+# differences between a report and a baseline report that are worse than the tolerances allow
+def regressions(report, baseline, tolerance, rate_tolerance):
+    found = []
+    if report['throughput_rps'] < baseline['throughput_rps'] * (1 - tolerance):
+        found.append('throughput %.1f req/s is below baseline %.1f req/s'
+                     % (report['throughput_rps'], baseline['throughput_rps']))
+
+    for rate in ('error_rate', 'lock_timeout_rate'):
+        if report[rate] > baseline[rate] + rate_tolerance:
+            found.append('%s %.4f is above baseline %.4f' % (rate, report[rate], baseline[rate]))
+
+    for name, endpoint in report['endpoints'].items():
+        baseline_endpoint = baseline['endpoints'].get(name)
+        if baseline_endpoint and endpoint['count'] and baseline_endpoint['count'] \
+                and endpoint['p95_ms'] > baseline_endpoint['p95_ms'] * (1 + tolerance):
+            found.append('%s p95 %.1f ms is above baseline %.1f ms'
+                         % (name, endpoint['p95_ms'], baseline_endpoint['p95_ms']))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run concurrent player and admin journeys against a local server.')
+    parser.add_argument('--players', type=int, default=8, help='concurrent player journeys')
+    parser.add_argument('--admins', type=int, default=1, help='concurrent admins playing rounds')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run for')
+    parser.add_argument('--tickets', type=int, default=5, help='draws bought per player journey')
+    parser.add_argument('--admin-interval', type=float, default=2, help='seconds between rounds')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='compare against this report and exit 1 on regressions')
+    parser.add_argument('--save-baseline', help='also write the report to this file as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative drop in throughput and rise in p95 latency')
+    parser.add_argument('--rate-tolerance', type=float, default=0.01,
+                        help='allowed absolute rise in error and lock timeout rates')
+    args = parser.parse_args()
+
+    report = run(args.players, args.admins, args.duration, args.tickets, args.admin_interval)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as output:
+                json.dump(report, output, indent=2)
+    if not args.output:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(report, json.load(baseline), args.tolerance, args.rate_tolerance)
+        for regression in found:
+            print('REGRESSION: ' + regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
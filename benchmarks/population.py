@@ -0,0 +1,77 @@
+# IMPORTS
+import os, pickle, random, tempfile
+
+# benchmarks run against a throwaway database, log and rate limit store, never the application's own, and logins are
+# never rate limited
+BENCHMARK_DIR = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BENCHMARK_DIR, 'benchmark.db')
+os.environ['SQLALCHEMY_ECHO'] = 'False'
+os.environ['LOG_FILE'] = os.path.join(BENCHMARK_DIR, 'lottery.log')
+os.environ['SECURITY_EVENTS_DB'] = os.path.join(BENCHMARK_DIR, 'security_events.db')
+os.environ['RATE_LIMIT_DB'] = os.path.join(BENCHMARK_DIR, 'rate_limit.db')
+os.environ['LOGIN_LIMIT_PER_IP'] = os.environ['LOGIN_LIMIT_PER_EMAIL'] = str(10 ** 9)
+
+from app import app, db
+from models import User, Draw, init_db, load_draw_key
+from sqlalchemy import insert
+
+# CONFIG
+# generated users (keys and password hashes) are cached here, they take far longer to make than everything else
+CACHE_DIR = os.getenv('BENCHMARK_CACHE_DIR', os.path.join(os.path.dirname(__file__), '.cache'))
+# password of every generated user
+PASSWORD = 'Player1!'
+POSTCODE = 'NE1 2AB'
+
+
+# returns `count` generated users as column values, with real RSA keys and bcrypt hashes. Users are cached per bcrypt
+# cost, a larger population only generates the users missing from the cache
+def generated_users(count):
+    path = os.path.join(CACHE_DIR, 'users-%d.pickle' % app.config['BCRYPT_ROUNDS'])
+    users = []
+    if os.path.exists(path):
+        with open(path, 'rb') as cache:
+            users = pickle.load(cache)
+
+    if len(users) < count:
+        with app.app_context():
+            for i in range(len(users), count):
+                user = User(email='player%d@email.com' % i, firstname='Player', lastname=str(i), phone='0191-123-4567',
+                            dob='01/01/1999', postcode=POSTCODE, password=PASSWORD, role='user')
+                users.append({column: getattr(user, column) for column in
+                              ('email', 'firstname', 'lastname', 'phone', 'dob', 'postcode', 'password', 'pin_key',
+                               'role', 'registered_on', 'successful_logins', 'public_key', 'private_key', 'draw_key')})
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + '.tmp', 'wb') as cache:
+            pickle.dump(users, cache)
+        os.replace(path + '.tmp', path)
+
+    return users[:count]
+
+
+# random sorted draw numbers, as submitted by the draw forms
+def random_numbers():
+    return ' '.join(map(str, sorted(random.sample(range(1, 61), 6))))
+
+
+# adds `tickets` unplayed draws for every player, encrypted with their own draw keys
+def add_tickets(tickets):
+    with app.app_context():
+        players = db.session.query(User.id, User.draw_key, User.private_key).filter(User.role == 'user').all()
+        for player in players:
+            draw_key = load_draw_key(player.id, player.draw_key, player.private_key)
+            db.session.execute(insert(Draw), [Draw.values(player.id, random_numbers(), False, 0, draw_key)
+                                              for i in range(tickets)])
+        db.session.commit()
+
+
+# resets the database to the admin plus `users` generated players with `tickets` unplayed draws each, and returns the
+# players' emails
+def seed(users, tickets):
+    init_db()
+    players = generated_users(users)
+    with app.app_context():
+        db.session.execute(insert(User), players)
+        db.session.commit()
+    add_tickets(tickets)
+    return [player['email'] for player in players]
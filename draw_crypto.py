@@ -0,0 +1,32 @@
+# IMPORTS
+import os, pickle, rsa
+from metrics import timed
+
+
+# keys can be passed either pickled (as stored in the database) or already deserialized
+def encrypt(data, public_key):
+    with timed('crypto'):
+        if isinstance(public_key, bytes):
+            public_key = pickle.loads(public_key)
+        return rsa.encrypt(data.encode(), public_key)
+
+def decrypt(data, private_key):
+    with timed('crypto'):
+        if isinstance(private_key, bytes):
+            private_key = pickle.loads(private_key)
+        return rsa.decrypt(data, private_key).decode()
+
+
+# draw storage formats, recorded on every draw so rows written in the old format still decrypt
+DRAW_RSA = 1       # numbers encrypted directly with the owner's RSA public key
+DRAW_ENVELOPE = 2  # numbers encrypted with AES-GCM under the owner's RSA-wrapped draw key
+
+# symmetric encryption with an AESGCM draw key; the random nonce is stored in front of the ciphertext
+def seal(data, draw_key):
+    with timed('crypto'):
+        nonce = os.urandom(12)
+        return nonce + draw_key.encrypt(nonce, data.encode(), None)
+
+def unseal(data, draw_key):
+    with timed('crypto'):
+        return draw_key.decrypt(data[:12], data[12:], None).decode()
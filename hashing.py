@@ -0,0 +1,91 @@
+# IMPORTS
+import threading, time, bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from metrics import LatencyHistogram, timed
+
+
+# raised when the hashing pool has no free worker or queue slot; handled as a 503 like any other ServiceUnavailable
+class HashingPoolFull(ServiceUnavailable):
+    description = 'The server is busy checking passwords. Please try again shortly.'
+
+
+# fixed-size pool of threads that run every bcrypt hash and check, so a burst of logins cannot occupy every request
+# thread with hashing. bcrypt releases the GIL, so the workers hash in parallel. At most workers + queue_size hashes
+# are running or waiting at once; callers beyond that fail fast with HashingPoolFull
+class HashingPool:
+
+    def __init__(self, workers, queue_size, rounds):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.rehashed = 0
+        # time spent hashing in a worker, and time callers spent waiting for a free worker
+        self.latency = {'hash': LatencyHistogram(), 'check': LatencyHistogram(), 'wait': LatencyHistogram()}
+
+    def _run(self, kind, submitted, function, *args):
+        start = time.perf_counter()
+        self.latency['wait'].observe(start - submitted)
+        try:
+            return function(*args)
+        finally:
+            self.latency[kind].observe(time.perf_counter() - start)
+
+    # runs function in the pool and waits for its result
+    def _submit(self, kind, function, *args):
+        with timed('bcrypt'):
+            return self._wait(kind, function, *args)
+
+    def _wait(self, kind, function, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise HashingPoolFull()
+
+        try:
+            future = self.executor.submit(self._run, kind, time.perf_counter(), function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        return future.result()
+
+    # hashes a password with the configured cost factor
+    def hash(self, password):
+        return self._submit('hash', bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+
+    def check(self, password, hashed):
+        return self._submit('check', bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+    # True if hashed was made with a different cost factor than the configured one
+    def needs_rehash(self, hashed):
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        return int(hashed.split(b'$')[2]) != self.rounds
+
+    # returns a new hash of a just verified password if its cost factor is out of date, otherwise None. Also None
+    # when the pool is busy, so an upgrade never fails a login
+    def rehash(self, password, hashed):
+        if not self.needs_rehash(hashed):
+            return None
+        try:
+            hashed = self.hash(password)
+        except HashingPoolFull:
+            return None
+        with self.lock:
+            self.rehashed += 1
+        return hashed
+
+    def stats(self):
+        with self.lock:
+            stats = {'workers': self.workers,
+                     'queue_size': self.queue_size,
+                     'rounds': self.rounds,
+                     'rejected': self.rejected,
+                     'rehashed': self.rehashed}
+        stats['latency'] = {kind: histogram.stats() for kind, histogram in self.latency.items()}
+        return stats
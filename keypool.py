@@ -0,0 +1,99 @@
+# IMPORTS
+import os, queue, threading, time, rsa
+
+
+# pool of pre-generated RSA key pairs so that registration does not wait for key generation; background workers
+# refill the pool whenever its depth falls to the low-water mark and stop once it is full again. A registration that
+# finds the pool empty generates its key pair inline, at about the refill_rate reported by stats()
+class KeyPairPool:
+
+    def __init__(self, size, low_water, workers, bits=512):
+        self.size = size
+        self.low_water = low_water
+        self.workers = workers
+        self.bits = bits
+        self.started = False
+        self._reset()
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _reset(self):
+        self.keys = queue.Queue(maxsize=self.size)
+        self.refill_needed = threading.Event()
+        self.lock = threading.Lock()
+        self.generated = 0
+        self.generating_seconds = 0.0
+        self.taken = 0
+        self.fallbacks = 0
+
+    # a forked child refills a pool of its own: its copy of the parent's keys would hand the same key pairs to users
+    # registering in different processes, and the parent's refill threads do not survive the fork
+    def _forked(self):
+        self._reset()
+        if self.started:
+            self.started = False
+            self.start()
+
+    # starts the refill workers, filling the pool up to its size
+    def start(self):
+        with self.lock:
+            if self.started or self.size <= 0:
+                return
+            self.started = True
+
+        for i in range(self.workers):
+            threading.Thread(target=self._refill, name='key-pool-%d' % i, daemon=True).start()
+        self.refill_needed.set()
+
+    def _refill(self):
+        while True:
+            self.refill_needed.wait()
+
+            start = time.perf_counter()
+            key_pair = rsa.newkeys(self.bits)
+            elapsed = time.perf_counter() - start
+
+            try:
+                self.keys.put_nowait(key_pair)
+            except queue.Full:
+                self.refill_needed.clear()
+                continue
+
+            with self.lock:
+                self.generated += 1
+                self.generating_seconds += elapsed
+            if self.keys.full():
+                self.refill_needed.clear()
+
+    # returns a (public key, private key) pair, generating one inline when the pool is empty. The app starts the pool,
+    # this starts it in the processes where the app did not
+    def take(self):
+        if not self.started:
+            self.start()
+
+        try:
+            key_pair = self.keys.get_nowait()
+        except queue.Empty:
+            key_pair = None
+
+        if self.keys.qsize() <= self.low_water:
+            self.refill_needed.set()
+
+        with self.lock:
+            if key_pair:
+                self.taken += 1
+            else:
+                self.fallbacks += 1
+
+        return key_pair or rsa.newkeys(self.bits)
+
+    def stats(self):
+        with self.lock:
+            return {'depth': self.keys.qsize(),
+                    'size': self.size,
+                    'low_water': self.low_water,
+                    'workers': self.workers,
+                    'generated': self.generated,
+                    # key pairs one refill worker generates per second
+                    'refill_rate': self.generated / self.generating_seconds if self.generating_seconds else 0.0,
+                    'taken': self.taken,
+                    'fallbacks': self.fallbacks}
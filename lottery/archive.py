@@ -0,0 +1,102 @@
+# IMPORTS
+import time
+from datetime import datetime
+from app import app, db
+from models import Draw, ArchivedDraw
+from sqlalchemy import delete, func, insert, literal, select
+
+# CONFIG
+# columns copied from draws into archived_draws
+ARCHIVED_COLUMNS = ('id', 'user_id', 'numbers', 'encryption_version', 'lottery_round', 'matches', 'matches_master')
+
+
+# played user draws, all of them or one user's
+def played_filters(user_id):
+    played = (Draw.master_draw == False, Draw.been_played == True)
+    if user_id is not None:
+        played += (Draw.user_id == user_id,)
+    return played
+
+
+# ids of the next chunk of played user draws
+def played_draw_ids(user_id, last_id, chunk_size):
+    return db.session.query(Draw.id) \
+        .filter(*played_filters(user_id), Draw.id > last_id) \
+        .order_by(Draw.id) \
+        .limit(chunk_size)
+
+
+# ids of the next chunk of archived draws of a round
+def archived_draw_ids(lottery_round, last_id, chunk_size):
+    return db.session.query(ArchivedDraw.id) \
+        .filter(ArchivedDraw.lottery_round == lottery_round, ArchivedDraw.id > last_id) \
+        .order_by(ArchivedDraw.id) \
+        .limit(chunk_size)
+
+
+# archived rounds older than the newest `rounds` rounds, oldest first
+def expired_rounds(latest_round, rounds):
+    return db.session.query(ArchivedDraw.lottery_round) \
+        .filter(ArchivedDraw.lottery_round <= latest_round - rounds) \
+        .distinct() \
+        .order_by(ArchivedDraw.lottery_round)
+
+
+# moves played user draws, all of them or one user's, from draws into archived_draws. Each chunk is copied and deleted
+# in its own short transaction followed by a pause, so ticket submissions are never blocked for long
+def archive_played_draws(user_id=None, chunk_size=None, pause=None):
+    chunk_size = chunk_size or app.config['ARCHIVE_CHUNK_SIZE']
+    pause = app.config['ARCHIVE_PAUSE'] if pause is None else pause
+
+    played = played_filters(user_id)
+    archived = 0
+    last_id = 0
+    while True:
+        ids = [draw_id for draw_id, in played_draw_ids(user_id, last_id, chunk_size)]
+
+        if not ids:
+            return archived
+
+        chunk = (*played, Draw.id >= ids[0], Draw.id <= ids[-1])
+        db.session.execute(insert(ArchivedDraw).from_select(
+            [*ARCHIVED_COLUMNS, 'archived_on'],
+            select(*(getattr(Draw, column) for column in ARCHIVED_COLUMNS), literal(datetime.now())).where(*chunk)))
+        db.session.execute(delete(Draw).where(*chunk))
+        db.session.commit()
+
+        archived += len(ids)
+        last_id = ids[-1]
+        if pause:
+            time.sleep(pause)
+
+
+# deletes archived draws of rounds older than the newest `rounds` rounds, one chunk per transaction with a pause
+# between chunks; nothing is deleted when rounds is 0
+def purge_archive(rounds=None, chunk_size=None, pause=None):
+    rounds = app.config['ARCHIVE_RETENTION_ROUNDS'] if rounds is None else rounds
+    chunk_size = chunk_size or app.config['ARCHIVE_CHUNK_SIZE']
+    pause = app.config['ARCHIVE_PAUSE'] if pause is None else pause
+
+    latest_round = db.session.query(func.max(ArchivedDraw.lottery_round)).scalar()
+    if not rounds or latest_round is None:
+        return 0
+
+    # ids repeat across rounds, so each expired round is paged by id on its own along the (lottery_round, id) key
+    purged = 0
+    for lottery_round, in expired_rounds(latest_round, rounds).all():
+        last_id = 0
+        while True:
+            ids = [draw_id for draw_id, in archived_draw_ids(lottery_round, last_id, chunk_size)]
+
+            if not ids:
+                break
+
+            db.session.execute(delete(ArchivedDraw).where(ArchivedDraw.lottery_round == lottery_round,
+                                                          ArchivedDraw.id >= ids[0], ArchivedDraw.id <= ids[-1]))
+            db.session.commit()
+
+            purged += len(ids)
+            last_id = ids[-1]
+            if pause:
+                time.sleep(pause)
+    return purged
@@ -0,0 +1,271 @@
+# IMPORTS
+import json, threading, multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from app import app, db
+from models import User, Draw, ArchivedDraw, LotteryJob, RoundSummary, decrypt_draw, blind_index
+from lottery.matcher import numbers_to_mask, shard_draws, match_shard
+from sqlalchemy import event, func, select, union_all, update
+from sqlalchemy.dialects.sqlite import insert
+
+# CONFIG
+# maximum number of draw ids bound into a single UPDATE ... WHERE id IN (...) statement
+UPDATE_BATCH_SIZE = 500
+# worker processes are started from a clean server process rather than forked from the round's thread, which could copy
+# a lock (key cache, logging) held by another thread at that moment and hang the worker. They only import
+# lottery.matcher, which the fork server loads once for all of them
+WORKER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+worker_context = multiprocessing.get_context(WORKER_START_METHOD)
+if WORKER_START_METHOD == 'forkserver':
+    worker_context.set_forkserver_preload(['lottery.matcher'])
+
+# worker processes shared by every parallel round of this process, started by the first one
+worker_pool = None
+worker_pool_size = 0
+worker_pool_lock = threading.Lock()
+# user draws waiting for the next round
+UNPLAYED = (Draw.master_draw == False, Draw.been_played == False)
+
+
+# counts the SQL statements and commits issued by the current thread while active
+class QueryCounter:
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread = threading.get_ident()
+        self.queries = 0
+        self.commits = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count_query)
+        event.listen(self.engine, 'commit', self._count_commit)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count_query)
+        event.remove(self.engine, 'commit', self._count_commit)
+
+    def _count_query(self, *args):
+        if threading.get_ident() == self.thread:
+            self.queries += 1
+
+    def _count_commit(self, *args):
+        if threading.get_ident() == self.thread:
+            self.commits += 1
+
+
+# outcome of a lottery round: winners per prize tier plus the work done to find them
+class RoundResult:
+
+    def __init__(self, lottery_round):
+        self.lottery_round = lottery_round
+        self.winners = 0
+        self.tiers = {}
+        self.tickets = 0
+        self.decrypted = 0
+        self.queries = 0
+        self.commits = 0
+
+
+# returns the worker pool for LOTTERY_WORKERS processes, or None when rounds are played in this process. The pool
+# lives as long as the process, so only the first parallel round pays for starting the workers
+def round_executor():
+    global worker_pool, worker_pool_size
+    workers = app.config['LOTTERY_WORKERS']
+    with worker_pool_lock:
+        if worker_pool is not None and worker_pool_size != workers:
+            worker_pool.shutdown()
+            worker_pool = None
+        if worker_pool is None and workers > 1:
+            worker_pool = ProcessPoolExecutor(max_workers=workers, mp_context=worker_context)
+            worker_pool_size = workers
+        return worker_pool
+
+
+# drops a pool whose worker died, so the retried round starts new workers
+def discard_executor(broken):
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is broken:
+            worker_pool = None
+    broken.shutdown(wait=False)
+
+
+# matches a chunk of candidate draws against the winning numbers, in worker processes when an executor is given
+def match_chunk(chunk, match_args, executor):
+    shards = shard_draws(chunk, app.config['LOTTERY_WORKERS'] if executor else 1)
+    if len(shards) > 1:
+        return sorted(draw for shard_matches in executor.map(match_shard, shards, *map(repeat, match_args))
+                      for draw in shard_matches)
+    return [draw for shard in shards for draw in match_shard(shard, *match_args, decrypt_draw)]
+
+
+# the number of unplayed user draws and the last of them, which fixes the draws a new round plays
+def round_tickets():
+    return db.session.query(func.count(Draw.id), func.max(Draw.id)).filter(*UNPLAYED)
+
+
+# the candidate draws after id after and up to last_id in id order, with their owner's keys. Every unplayed draw has to
+# be decrypted to find partial matches; when only the jackpot is paid, just the draws whose blind index matches and the
+# draws not indexed yet. Each of the two is looked up on its own so both use ix_draws_unplayed_blind_index, and the
+# two id ordered lookups are merged
+def round_candidates(winning_numbers, lowest_tier, after, last_id):
+    columns = (Draw.id, Draw.user_id, Draw.numbers, Draw.encryption_version)
+    in_range = UNPLAYED + (Draw.id > after, Draw.id <= last_id)
+    if lowest_tier == 6:
+        draws = union_all(select(*columns).where(*in_range, Draw.blind_index == blind_index(winning_numbers)),
+                          select(*columns).where(*in_range, Draw.blind_index.is_(None))).subquery()
+    else:
+        draws = select(*columns).where(*in_range).subquery()
+    return db.session.query(draws.c.id, draws.c.user_id, draws.c.numbers, draws.c.encryption_version,
+                            User.draw_key, User.private_key) \
+        .join(User, User.id == draws.c.user_id) \
+        .order_by(draws.c.id)
+
+
+# unplayed draws per owner in a chunk's id range
+def chunk_tickets(checkpoint_id, chunk_end):
+    return db.session.query(Draw.user_id, func.count(Draw.id)) \
+        .filter(*UNPLAYED, Draw.id > checkpoint_id, Draw.id <= chunk_end) \
+        .group_by(Draw.user_id)
+
+
+# plays every unplayed user draw against the winning draw in chunks of LOTTERY_CHUNK_SIZE candidate draws, so only one
+# chunk is ever held in memory. Each chunk is committed together with the round's checkpoint, its LotteryJob row, and an
+# interrupted round resumes after the last committed chunk
+def run_round(winning_draw, job=None):
+    round_result = RoundResult(winning_draw.lottery_round)
+
+    with QueryCounter(db.engine) as counter:
+        if job is None:
+            job = LotteryJob.query.filter_by(lottery_round=winning_draw.lottery_round).first()
+        if job is None:
+            job = LotteryJob(lottery_round=winning_draw.lottery_round, winning_draw_id=winning_draw.id)
+            db.session.add(job)
+
+        # decrypt the winning numbers once for the whole round with the keys of the admin who generated them
+        admin = db.session.get(User, winning_draw.user_id)
+        winning_numbers = decrypt_draw(winning_draw.numbers, winning_draw.encryption_version,
+                                       admin.id, admin.draw_key, admin.private_key)
+
+        lowest_tier = min(app.config['LOTTERY_PRIZE_TIERS'])
+
+        # a new round counts its unplayed user draws and fixes its last draw; draws submitted after this point have a
+        # higher id and wait for the next round
+        if job.last_id is None:
+            job.tickets, job.last_id = round_tickets().one()
+            if not job.tickets:
+                db.session.rollback()
+                return round_result
+            job.decrypted = round_candidates(winning_numbers, lowest_tier, 0, job.last_id).order_by(None).count()
+            job.checkpoint_id = 0
+            job.processed = job.winners = 0
+            job.result = json.dumps({'tiers': {tier: 0 for tier in app.config['LOTTERY_PRIZE_TIERS']}})
+            db.session.commit()
+
+        tiers = {int(tier): winners for tier, winners in json.loads(job.result)['tiers'].items()}
+        match_args = (numbers_to_mask(winning_numbers), lowest_tier)
+        chunk_size = app.config['LOTTERY_CHUNK_SIZE']
+
+        add_summaries = insert(RoundSummary)
+        add_summaries = add_summaries.on_conflict_do_update(
+            index_elements=[RoundSummary.user_id, RoundSummary.lottery_round],
+            set_={'tickets': RoundSummary.tickets + add_summaries.excluded.tickets,
+                  'winning_lines': RoundSummary.winning_lines + add_summaries.excluded.winning_lines,
+                  'top_matches': func.max(RoundSummary.top_matches, add_summaries.excluded.top_matches)})
+
+        executor = round_executor()
+        try:
+            while job.checkpoint_id < job.last_id:
+                chunk = round_candidates(winning_numbers, lowest_tier, job.checkpoint_id, job.last_id) \
+                    .limit(chunk_size).all()
+
+                # a full chunk ends at its last candidate, a partial one is the last and ends the round
+                chunk_end = chunk[-1].id if len(chunk) == chunk_size else job.last_id
+
+                # decrypt and count matched numbers for every candidate in the chunk
+                owners = {draw.id: draw.user_id for draw in chunk}
+                winning_ids = {tier: [] for tier in tiers}
+                summaries = {}
+                for draw_id, numbers, draw_matches in match_chunk(chunk, match_args, executor):
+                    if draw_matches in winning_ids:
+                        winning_ids[draw_matches].append(draw_id)
+                        summary = summaries.setdefault(owners[draw_id], [0, 0, 0])
+                        summary[1] += 1
+                        summary[2] = max(summary[2], draw_matches)
+
+                # add the chunk to each player's round summary, counting every draw in the chunk's id range
+                for user_id, tickets in chunk_tickets(job.checkpoint_id, chunk_end):
+                    summaries.setdefault(user_id, [0, 0, 0])[0] = tickets
+                if summaries:
+                    db.session.execute(add_summaries, [
+                        {'user_id': user_id, 'lottery_round': winning_draw.lottery_round, 'tickets': tickets,
+                         'winning_lines': winning_lines, 'top_matches': top_matches, 'played_on': datetime.now()}
+                        for user_id, (tickets, winning_lines, top_matches) in summaries.items()])
+
+                # mark every draw in the chunk's id range as played in this round, candidates or not
+                db.session.execute(update(Draw)
+                                   .where(*UNPLAYED, Draw.id > job.checkpoint_id, Draw.id <= chunk_end)
+                                   .values(been_played=True, lottery_round=winning_draw.lottery_round),
+                                   execution_options={'synchronize_session': False})
+
+                # record the prize tier of the winning draws, only draws matching all six numbers match the master draw
+                for tier, ids in winning_ids.items():
+                    tiers[tier] += len(ids)
+                    job.winners += len(ids)
+                    for i in range(0, len(ids), UPDATE_BATCH_SIZE):
+                        db.session.execute(update(Draw)
+                                           .where(Draw.id.in_(ids[i:i + UPDATE_BATCH_SIZE]))
+                                           .values(matches=tier, matches_master=tier == 6),
+                                           execution_options={'synchronize_session': False})
+
+                # move the checkpoint past the chunk, the last chunk also plays the winning draw
+                job.checkpoint_id = chunk_end
+                job.processed += len(chunk)
+                job.result = json.dumps({'tiers': tiers})
+                job.updated_at = datetime.now()
+                if chunk_end == job.last_id:
+                    winning_draw.been_played = True
+                    job.status = 'finished'
+                    job.finished_at = job.updated_at
+                    # the work of this run, counting the commit that finishes the round
+                    job.queries = counter.queries
+                    job.commits = counter.commits + 1
+                db.session.commit()
+        except BrokenProcessPool:
+            discard_executor(executor)
+            raise
+
+        round_result.tickets = job.tickets
+        round_result.decrypted = job.decrypted
+        round_result.winners = job.winners
+        round_result.tiers = tiers
+
+    round_result.queries = counter.queries
+    round_result.commits = counter.commits
+    return round_result
+
+
+# the winning draws of a round after the given id with their owner's email and keys, read from the draws table and the
+# archive, as the round is archived after it has been played
+def winning_draws(lottery_round, after, limit):
+    draws = union_all(*(select(table.id, table.user_id, table.numbers, table.encryption_version, table.matches)
+                        .where(table.lottery_round == lottery_round, table.matches > 0, table.id > after)
+                        for table in (Draw, ArchivedDraw))).subquery()
+    return db.session.query(draws, User.email, User.draw_key, User.private_key) \
+        .join(User, User.id == draws.c.user_id) \
+        .order_by(draws.c.id) \
+        .limit(limit)
+
+
+# returns a page of the winning draws of a round, decrypted, as (round, numbers, user id, email, matches), and the id
+# after which the next page starts (None on the last page)
+def round_winners(lottery_round, after=0, limit=50):
+    winners = winning_draws(lottery_round, after, limit + 1).all()
+
+    results = [(lottery_round, decrypt_draw(draw.numbers, draw.encryption_version, draw.user_id, draw.draw_key,
+                                            draw.private_key), draw.user_id, draw.email, draw.matches)
+               for draw in winners[:limit]]
+    return results, winners[limit - 1].id if len(winners) > limit else None
@@ -1,6 +1,6 @@
-from flask import flash
+from flask import flash, current_app
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, SubmitField
+from wtforms import IntegerField, SubmitField, TextAreaField
 from wtforms.validators import InputRequired, NumberRange
 
 # form for lottery draw manual inputs
@@ -33,3 +33,60 @@ class DrawForm(FlaskForm):
     number5 = IntegerField(id='no5', validators=[InputRequired(), NumberRange(min=1, max=60)])
     number6 = IntegerField(id='no6', validators=[InputRequired(), NumberRange(min=1, max=60)])
     submit = SubmitField("Submit Draw")
+
+
+
+# form for submitting several draws at once, one line of six numbers per draw
+class BulkDrawForm(FlaskForm):
+
+    def validate(self, **kwargs):
+
+        if not super().validate():
+            return False
+
+        lines = [line.split() for line in self.draws.data.splitlines() if line.strip()]
+        if len(lines) > current_app.config['MAX_DRAWS_PER_REQUEST']:
+            flash("At most %d draws can be submitted at once" % current_app.config['MAX_DRAWS_PER_REQUEST'])
+            return False
+
+        # sorted, space separated numbers of every valid line
+        self.numbers = []
+        for line_number, line in enumerate(lines, 1):
+            if not all(value.isdigit() for value in line):
+                flash("Line %d must only contain whole numbers" % line_number)
+                return False
+
+            values = sorted(map(int, line))
+            if len(values) != 6 or not all(1 <= value <= 60 for value in values):
+                flash("Line %d must contain six numbers between 1 and 60" % line_number)
+                return False
+            if len(set(values)) != 6:
+                flash("Each number must be unique (line %d)" % line_number)
+                return False
+
+            self.numbers.append(" ".join(map(str, values)))
+
+        return True
+
+    # one draw per line, numbers separated by spaces
+    draws = TextAreaField(id='draws', validators=[InputRequired()])
+    submit = SubmitField("Submit Draws")
+
+
+
+# form for the server-side lucky dip, number of random draws to create
+class LuckyDipForm(FlaskForm):
+
+    def validate(self, **kwargs):
+
+        if not super().validate():
+            return False
+
+        if self.count.data > current_app.config['MAX_DRAWS_PER_REQUEST']:
+            flash("At most %d draws can be submitted at once" % current_app.config['MAX_DRAWS_PER_REQUEST'])
+            return False
+
+        return True
+
+    count = IntegerField(id='count', validators=[InputRequired(), NumberRange(min=1)])
+    submit = SubmitField("Lucky Dip")
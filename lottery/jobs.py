@@ -0,0 +1,82 @@
+# IMPORTS
+import logging, threading
+from datetime import datetime, timedelta
+from app import app, db
+from models import Draw, LotteryJob
+from lottery.engine import run_round
+from lottery.archive import archive_played_draws, purge_archive
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+
+
+# updates a job in its own short transaction, so progress is visible while the round's transaction is still open
+def update_job(job_id, **values):
+    with db.engine.begin() as connection:
+        connection.execute(update(LotteryJob).where(LotteryJob.id == job_id).values(updated_at=datetime.now(), **values))
+
+
+# starts a background job playing the winning draw and returns it. A round is only played once: if a job for the round
+# already exists it is returned instead, unless it failed, found no draws or stopped reporting progress, in which case
+# it is started again and resumes from its last checkpoint
+def start_round_job(winning_draw):
+    job = LotteryJob(lottery_round=winning_draw.lottery_round, winning_draw_id=winning_draw.id)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+        # only the request whose update claims the job starts it again
+        stale = datetime.now() - timedelta(seconds=app.config['LOTTERY_JOB_TIMEOUT'])
+        claimed = db.session.execute(update(LotteryJob)
+                                     .where(LotteryJob.lottery_round == winning_draw.lottery_round,
+                                            or_(LotteryJob.status.in_(('failed', 'empty')),
+                                                and_(LotteryJob.status.in_(('queued', 'running')),
+                                                     LotteryJob.updated_at < stale)))
+                                     .values(status='queued', error=None, finished_at=None,
+                                             updated_at=datetime.now())).rowcount
+        db.session.commit()
+
+        job = LotteryJob.query.filter_by(lottery_round=winning_draw.lottery_round).one()
+        if not claimed:
+            return job
+
+    threading.Thread(target=run_job, args=(job.id,), name='lottery-round-%d' % job.lottery_round, daemon=True).start()
+    return job
+
+
+# plays a job's round in a background thread with its own app context and database session, then archives it
+def run_job(job_id):
+    with app.app_context():
+        try:
+            job = db.session.get(LotteryJob, job_id)
+            winning_draw = db.session.get(Draw, job.winning_draw_id)
+            if not winning_draw or winning_draw.been_played:
+                raise ValueError('Winning draw %s is no longer unplayed' % job.winning_draw_id)
+            update_job(job_id, status='running', started_at=job.started_at or datetime.now())
+            db.session.refresh(job)
+
+            # progress is committed with every chunk of the round
+            round_result = run_round(winning_draw, job)
+
+            if not round_result.tickets:
+                update_job(job_id, status='empty', finished_at=datetime.now())
+                return
+        except Exception as error:
+            logging.exception('Lottery round job %s failed', job_id)
+            db.session.rollback()
+            update_job(job_id, status='failed', error=str(error), finished_at=datetime.now())
+            db.session.remove()
+            return
+
+        # leave only the next round's draws in the draws table. The round is already finished, so a failure here only
+        # records the error: the draws left behind are archived with the next round
+        try:
+            archive_played_draws()
+            purge_archive()
+        except Exception as error:
+            logging.exception('Archiving lottery round job %s failed', job_id)
+            db.session.rollback()
+            update_job(job_id, error=str(error))
+        finally:
+            db.session.remove()
@@ -0,0 +1,20 @@
+# IMPORTS
+import secrets
+
+# CONFIG
+# unbiased random choices from the operating system's CSPRNG
+system_random = secrets.SystemRandom()
+
+
+# returns count different draws, each six unique numbers between 1 and 60, sorted and space separated
+def lucky_dip(count):
+    draws = []
+    seen = set()
+
+    while len(draws) < count:
+        numbers = " ".join(map(str, sorted(system_random.sample(range(1, 61), 6))))
+        if numbers not in seen:
+            seen.add(numbers)
+            draws.append(numbers)
+
+    return draws
@@ -0,0 +1,90 @@
+# IMPORTS
+import pickle, rsa
+import numpy as np
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from draw_crypto import decrypt, unseal, DRAW_ENVELOPE
+from metrics import timed
+
+# this module is all a round's worker processes import, so it must not import the app
+
+# CONFIG
+# shards created per worker process when a round is run in parallel
+SHARDS_PER_WORKER = 4
+# users whose unwrapped keys a worker process keeps between shards
+WORKER_KEY_CACHE_SIZE = 10000
+# number of set bits in every byte value, used when numpy has no bitwise_count (numpy < 2.0)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+# compact ticket representation: bit n-1 is set for every number n, numbers are 1-60 so a ticket fits in 64 bits
+def numbers_to_mask(numbers):
+    mask = 0
+    for number in numbers.split():
+        mask |= 1 << (int(number) - 1)
+    return mask
+
+
+# counts how many numbers every ticket shares with the winning ticket, for a whole round at once
+def count_matches(masks, winning_mask):
+    shared = np.asarray(masks, dtype=np.uint64) & np.uint64(winning_mask)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(shared)
+    return POPCOUNT_TABLE[shared.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+
+# unwrapped keys of the users a worker process has matched draws of: user id -> (stored draw key, stored private key,
+# draw key, private key). The stored keys are compared on every use, so a changed key is never served
+worker_keys = {}
+
+
+# decrypts stored draw numbers in a worker process, like models.decrypt_draw but without the app's key cache
+def decrypt_worker_draw(numbers, encryption_version, user_id, draw_key, private_key):
+    keys = worker_keys.get(user_id)
+    if keys is None or keys[0] != draw_key or keys[1] != private_key:
+        if len(worker_keys) >= WORKER_KEY_CACHE_SIZE:
+            worker_keys.clear()
+        unwrapped_private_key = pickle.loads(private_key)
+        with timed('crypto'):
+            unwrapped_draw_key = AESGCM(rsa.decrypt(draw_key, unwrapped_private_key)) if draw_key else None
+        keys = worker_keys[user_id] = (draw_key, private_key, unwrapped_draw_key, unwrapped_private_key)
+
+    if encryption_version == DRAW_ENVELOPE:
+        return unseal(numbers, keys[2])
+    return decrypt(numbers, keys[3])
+
+
+# splits draws into shards by owner, each shard carrying only the keys of its own users
+def shard_draws(draws, workers):
+    if not draws:
+        return []
+
+    by_user = {}
+    keys = {}
+    for draw in draws:
+        by_user.setdefault(draw.user_id, []).append((draw.id, draw.user_id, draw.numbers, draw.encryption_version))
+        keys[draw.user_id] = (draw.draw_key, draw.private_key)
+
+    # a single shard keeps the draws in id order
+    if workers <= 1 or len(by_user) == 1:
+        return [{'keys': keys, 'draws': [(draw.id, draw.user_id, draw.numbers, draw.encryption_version) for draw in draws]}]
+
+    # a few shards per worker keeps the workers busy when users hold very different numbers of draws
+    shards = [{'keys': {}, 'draws': []} for i in range(min(len(by_user), workers * SHARDS_PER_WORKER))]
+
+    # largest users first, each into the currently smallest shard
+    for user_id, user_draws in sorted(by_user.items(), key=lambda item: len(item[1]), reverse=True):
+        shard = min(shards, key=lambda shard: len(shard['draws']))
+        shard['keys'][user_id] = keys[user_id]
+        shard['draws'].extend(user_draws)
+    return shards
+
+
+# decrypts a shard of draws and counts their matched numbers; returns (draw id, numbers, matches) for every draw
+# reaching the lowest prize tier. Runs in the round's process with the app's decrypt_draw, or in a worker process with
+# decrypt_worker_draw
+def match_shard(shard, winning_mask, lowest_tier, decrypt_draw=None):
+    decrypt_draw = decrypt_draw or decrypt_worker_draw
+    numbers = [decrypt_draw(draw_numbers, encryption_version, user_id, *shard['keys'][user_id])
+               for draw_id, user_id, draw_numbers, encryption_version in shard['draws']]
+    matches = count_matches([numbers_to_mask(n) for n in numbers], winning_mask)
+    return [(shard['draws'][i][0], numbers[i], int(matches[i])) for i in np.flatnonzero(matches >= lowest_tier)]
@@ -1,15 +1,28 @@
 # IMPORTS
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, flash, redirect, url_for
 from app import db, requires_roles
-from lottery.forms import DrawForm
-from models import Draw
+from lottery.forms import DrawForm, BulkDrawForm, LuckyDipForm
+from lottery.lucky_dip import lucky_dip
+from lottery.archive import archive_played_draws
+from models import Draw, RoundSummary
 from flask_login import current_user, login_required
+from sqlalchemy import insert
 from sqlalchemy.orm import make_transient
 
 # CONFIG
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
 
 
+# a user's draws that have not been played
+def playable_draws(user_id):
+    return Draw.query.filter_by(been_played=False, user_id=user_id)
+
+
+# a user's round summaries, latest round first
+def round_summaries(user_id):
+    return RoundSummary.query.filter_by(user_id=user_id).order_by(RoundSummary.lottery_round.desc())
+
+
 # VIEWS
 # view lottery page
 @lottery_blueprint.route('/lottery')
@@ -41,7 +54,7 @@ def create_draw():
         Commenting out Symmetric Encryption
         new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers, master_draw=False, lottery_round=0, draw_key=current_user.draw_key)
         '''
-        new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers, master_draw=False, lottery_round=0, public_key=current_user.public_key)
+        new_draw = Draw(user_id=current_user.id, numbers=submitted_numbers, master_draw=False, lottery_round=0, draw_key=current_user.get_draw_key())
         # add the new draw to the database
         db.session.add(new_draw)
         db.session.commit()
@@ -53,24 +66,65 @@ def create_draw():
     return render_template('lottery/lottery.html', name=current_user.firstname, form=form)
 
 
+# seals draws with the current user's draw key and stores them with one bulk insert and commit
+def insert_draws(draws):
+    draw_key = current_user.get_draw_key()
+    db.session.execute(insert(Draw), [Draw.values(current_user.id, numbers, False, 0, draw_key) for numbers in draws])
+    db.session.commit()
+
+
+# submit several draws at once
+@lottery_blueprint.route('/create_draws', methods=['POST'])
+@login_required
+@requires_roles('user')
+def create_draws():
+    form = BulkDrawForm()
+
+    if form.validate_on_submit():
+        insert_draws(form.numbers)
+
+        # re-render lottery.page
+        flash('%d draws submitted.' % len(form.numbers))
+        return redirect(url_for('lottery.lottery'))
+
+    return render_template('lottery/lottery.html', name=current_user.firstname, bulk_form=form)
+
+
+# create and submit a number of random draws
+@lottery_blueprint.route('/lucky_dip', methods=['POST'])
+@login_required
+@requires_roles('user')
+def create_lucky_dip():
+    form = LuckyDipForm()
+
+    if form.validate_on_submit():
+        insert_draws(lucky_dip(form.count.data))
+
+        # re-render lottery.page
+        flash('%d lucky dip draws submitted.' % form.count.data)
+        return redirect(url_for('lottery.lottery'))
+
+    return render_template('lottery/lottery.html', name=current_user.firstname, lucky_dip_form=form)
+
+
 # view all draws that have not been played
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 @login_required
 @requires_roles('user')
 def view_draws():
     # get all draws that have not been played [played=0]
-    playable_draws = Draw.query.filter_by(been_played=False, user_id=current_user.id).all()
+    draws = playable_draws(current_user.id).all()
 
     # if playable draws exist
-    if len(playable_draws) != 0:
+    if len(draws) != 0:
         # does not change the values of the database
         # decrypt all the draws for viewability
-        for j in playable_draws:
+        for j in draws:
             make_transient(j)
-            j.view_draw(current_user.private_key)
+            j.view_draw(current_user)
             #j.view_draw(current_user.draw_key)
         # re-render lottery page with playable draws
-        return render_template('lottery/lottery.html', playable_draws=playable_draws)
+        return render_template('lottery/lottery.html', playable_draws=draws)
     else:
         flash('No playable draws.')
         return lottery()
@@ -81,12 +135,12 @@ def view_draws():
 @login_required
 @requires_roles('user')
 def check_draws():
-    # get played draws
-    played_draws = Draw.query.filter_by(been_played=True, user_id=current_user.id).all()
+    # get the summary of the latest round the user played in
+    latest_round = round_summaries(current_user.id).first()
 
     # if played draws exist
-    if len(played_draws) != 0:
-        return render_template('lottery/lottery.html', results=played_draws, played=True)
+    if latest_round:
+        return render_template('lottery/lottery.html', results=[latest_round], played=True)
 
     # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
     else:
@@ -94,15 +148,28 @@ def check_draws():
         return lottery()
 
 
-# delete all played draws
+# view the results of every round the user played in
+@lottery_blueprint.route('/history', methods=['POST'])
+@login_required
+@requires_roles('user')
+def history():
+    rounds = round_summaries(current_user.id).all()
+
+    if not rounds:
+        flash("You have not played in any lottery rounds yet.")
+        return lottery()
+
+    return render_template('lottery/lottery.html', results=rounds, history=True)
+
+
+# clear the user's played draws; they are kept in the archive for their round history
 @lottery_blueprint.route('/play_again', methods=['POST'])
 @login_required
 @requires_roles('user')
 def play_again():
-    Draw.query.filter_by(been_played=True, master_draw=False).delete(synchronize_session=False)
-    db.session.commit()
+    archive_played_draws(user_id=current_user.id, pause=0)
 
-    flash("All played draws deleted.")
+    flash("All played draws cleared.")
     return lottery()
 
 
@@ -0,0 +1,199 @@
+# IMPORTS
+import bisect, threading, time
+from contextlib import contextmanager
+
+
+# upper bounds, in seconds, of the latency histogram buckets; the last bucket holds everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# thread-safe latency histogram with fixed buckets
+class LatencyHistogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+
+    # approximate quantile, reported as the upper bound of the bucket it falls in
+    def quantile(self, q, counts=None):
+        counts = counts or self.counts
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return 0.0
+
+    def stats(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.total
+        count = sum(counts)
+        return {'count': count,
+                'mean': total / count if count else 0.0,
+                'p50': self.quantile(0.5, counts),
+                'p95': self.quantile(0.95, counts),
+                'p99': self.quantile(0.99, counts),
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], counts))}
+
+
+# counters of the request being served by the current thread; background threads have none
+current = threading.local()
+
+# kinds of time recorded per request besides SQL
+TIMED_KINDS = ('crypto', 'bcrypt')
+
+
+# adds the time spent inside to the current request's counter of this kind (crypto or bcrypt)
+@contextmanager
+def timed(kind):
+    counters = getattr(current, 'counters', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if counters is not None:
+            counters[kind + '_seconds'] += time.perf_counter() - start
+
+
+# per-endpoint latency histograms, SQL query counts and time, and crypto and bcrypt time, plus the stats of the
+# caches and pools serving the requests
+class RequestMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        # callbacks called with (endpoint, counters) after every request, see assert_max_queries
+        self.observers = []
+        # component name -> (stats callable, names of its stats that only ever increase)
+        self.components = {}
+
+    # reports a component's stats with the request metrics. stats returns a dict of numbers, or of latency histogram
+    # stats by kind
+    def register(self, name, stats, counters=()):
+        self.components[name] = (stats, counters)
+
+    def component_stats(self):
+        return {name: stats() for name, (stats, counters) in sorted(self.components.items())}
+
+    def start(self):
+        current.counters = dict({'queries': 0, 'query_seconds': 0.0},
+                                **{kind + '_seconds': 0.0 for kind in TIMED_KINDS})
+        current.start = time.perf_counter()
+
+    def query(self, seconds):
+        counters = getattr(current, 'counters', None)
+        if counters is not None:
+            counters['queries'] += 1
+            counters['query_seconds'] += seconds
+
+    def finish(self, endpoint, status):
+        counters = getattr(current, 'counters', None)
+        if counters is None:
+            return
+        del current.counters
+        seconds = time.perf_counter() - current.start
+
+        with self.lock:
+            metrics = self.endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self.endpoints[endpoint] = dict({'latency': LatencyHistogram(), 'requests': 0, 'errors': 0,
+                                                           'max_queries': 0},
+                                                          **{name: 0 for name in counters})
+            metrics['requests'] += 1
+            metrics['errors'] += status >= 500
+            metrics['max_queries'] = max(metrics['max_queries'], counters['queries'])
+            for name, value in counters.items():
+                metrics[name] += value
+        metrics['latency'].observe(seconds)
+
+        for observer in list(self.observers):
+            observer(endpoint, counters)
+
+    def stats(self):
+        with self.lock:
+            endpoints = {endpoint: dict(metrics) for endpoint, metrics in self.endpoints.items()}
+        for metrics in endpoints.values():
+            metrics['latency'] = metrics['latency'].stats()
+        return endpoints
+
+    # the metrics in the Prometheus text exposition format
+    def prometheus(self, prefix='lottery'):
+        endpoints = self.stats()
+        lines = ['# HELP %s_request_duration_seconds Request latency by endpoint.' % prefix,
+                 '# TYPE %s_request_duration_seconds histogram' % prefix]
+        for endpoint, metrics in sorted(endpoints.items()):
+            cumulative = 0
+            for bound, count in metrics['latency']['buckets'].items():
+                cumulative += count
+                lines.append('%s_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                             % (prefix, endpoint, bound, cumulative))
+            lines.append('%s_request_duration_seconds_sum{endpoint="%s"} %f'
+                         % (prefix, endpoint, metrics['latency']['mean'] * metrics['latency']['count']))
+            lines.append('%s_request_duration_seconds_count{endpoint="%s"} %d'
+                         % (prefix, endpoint, metrics['latency']['count']))
+
+        for name, kind, description in (('requests', 'counter', 'Requests served'),
+                                        ('errors', 'counter', 'Requests answered with a 5xx status'),
+                                        ('queries', 'counter', 'SQL statements issued'),
+                                        ('max_queries', 'gauge', 'Most SQL statements issued by one request'),
+                                        ('query_seconds', 'counter', 'Time spent in SQL statements'),
+                                        ('crypto_seconds', 'counter', 'Time spent encrypting and decrypting'),
+                                        ('bcrypt_seconds', 'counter', 'Time spent hashing and checking passwords')):
+            metric = '%s_request_%s%s' % (prefix, name, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s by endpoint.' % (metric, description))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for endpoint, metrics in sorted(endpoints.items()):
+                lines.append('%s{endpoint="%s"} %s' % (metric, endpoint, metrics[name]))
+
+        for component, (stats, counters) in sorted(self.components.items()):
+            for name, value in sorted(stats().items()):
+                if isinstance(value, dict):
+                    metric = '%s_%s_%s_seconds' % (prefix, component, name)
+                    lines.append('# HELP %s %s %s by kind.' % (metric, component, name))
+                    lines.append('# TYPE %s histogram' % metric)
+                    for kind, histogram in sorted(value.items()):
+                        cumulative = 0
+                        for bound, count in histogram['buckets'].items():
+                            cumulative += count
+                            lines.append('%s_bucket{kind="%s",le="%s"} %d' % (metric, kind, bound, cumulative))
+                        lines.append('%s_sum{kind="%s"} %f' % (metric, kind, histogram['mean'] * histogram['count']))
+                        lines.append('%s_count{kind="%s"} %d' % (metric, kind, histogram['count']))
+                else:
+                    kind = 'counter' if name in counters else 'gauge'
+                    metric = '%s_%s_%s%s' % (prefix, component, name, '_total' if kind == 'counter' else '')
+                    lines.append('# HELP %s %s %s.' % (metric, component, name))
+                    lines.append('# TYPE %s %s' % (metric, kind))
+                    lines.append('%s %s' % (metric, value))
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+# test helper: fails if any request completed inside the block issued more than `limit` SQL statements, e.g.
+#     with assert_max_queries(4):
+#         client.post('/view_draws')
+@contextmanager
+def assert_max_queries(limit):
+    requests = []
+
+    def observe(endpoint, counters):
+        requests.append((endpoint, counters['queries']))
+
+    request_metrics.observers.append(observe)
+    try:
+        yield requests
+    finally:
+        request_metrics.observers.remove(observe)
+
+    over = ['%s issued %d queries' % (endpoint, queries) for endpoint, queries in requests if queries > limit]
+    assert not over, 'more than %d queries per request: %s' % (limit, ', '.join(over))
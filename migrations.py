@@ -0,0 +1,240 @@
+# IMPORTS
+import click
+from app import app, db
+from models import User, Draw, RoundSummary, DRAW_RSA, DRAW_ENVELOPE, decrypt, decrypt_draw, seal, blind_index
+from sqlalchemy import case, func, inspect, text, update
+from sqlalchemy.dialects.sqlite import insert
+from lottery.archive import archive_played_draws, purge_archive, played_draw_ids, archived_draw_ids, expired_rounds
+from lottery.engine import UNPLAYED, round_tickets, round_candidates, chunk_tickets, winning_draws
+from lottery.views import playable_draws, round_summaries
+from admin.views import winning_draw
+
+
+# brings an existing database up to date with the models: creates missing tables, columns and indexes
+def upgrade_schema():
+    with app.app_context():
+        db.create_all()
+        inspector = inspect(db.engine)
+
+        with db.engine.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+
+                for column in table.columns:
+                    if column.name in existing_columns:
+                        continue
+
+                    # sqlite can only add a NOT NULL column if it has a default value
+                    column_definition = '%s %s' % (column.name, column.type.compile(dialect=db.engine.dialect))
+                    if column.server_default is not None:
+                        column_definition += " NOT NULL DEFAULT '%s'" % column.server_default.arg
+
+                    connection.execute(text('ALTER TABLE %s ADD COLUMN %s' % (table.name, column_definition)))
+
+                # indexes declared on the models are only created with new tables, so add any that are missing
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+            # replaced by ix_draws_unplayed_blind_index, the planner never chose it for a round
+            connection.execute(text('DROP INDEX IF EXISTS ix_draws_blind_index'))
+
+
+# re-encrypts draws stored in the old RSA-only format with their owner's draw key, one batch per commit
+def upgrade_draw_encryption(batch_size=500):
+    with app.app_context():
+        upgraded = 0
+        last_id = 0
+
+        while True:
+            draws = db.session.query(Draw.id, Draw.user_id, Draw.numbers) \
+                .filter(Draw.encryption_version == DRAW_RSA, Draw.id > last_id) \
+                .order_by(Draw.id) \
+                .limit(batch_size) \
+                .all()
+
+            if not draws:
+                return upgraded
+
+            owners = {user.id: user for user in User.query.filter(User.id.in_({draw.user_id for draw in draws}))}
+
+            # decrypt with the owner's private key and seal again with their draw key
+            changes = []
+            for draw in draws:
+                owner = owners[draw.user_id]
+                numbers = decrypt(draw.numbers, owner.get_private_key())
+                changes.append({'id': draw.id,
+                                'numbers': seal(numbers, owner.get_draw_key()),
+                                'encryption_version': DRAW_ENVELOPE,
+                                'blind_index': blind_index(numbers)})
+
+            # bulk update by primary key; also saves draw keys created for older users
+            db.session.execute(update(Draw), changes)
+            db.session.commit()
+
+            upgraded += len(draws)
+            last_id = draws[-1].id
+
+
+# computes the blind index of draws created before blind indexing, one batch per commit
+def backfill_blind_index(batch_size=500):
+    with app.app_context():
+        backfilled = 0
+        last_id = 0
+
+        while True:
+            draws = db.session.query(Draw.id, Draw.user_id, Draw.numbers, Draw.encryption_version,
+                                     User.draw_key, User.private_key) \
+                .join(User, User.id == Draw.user_id) \
+                .filter(Draw.id > last_id, Draw.blind_index.is_(None)) \
+                .order_by(Draw.id) \
+                .limit(batch_size) \
+                .all()
+
+            if not draws:
+                return backfilled
+
+            changes = [{'id': draw.id,
+                        'blind_index': blind_index(decrypt_draw(draw.numbers, draw.encryption_version,
+                                                                draw.user_id, draw.draw_key, draw.private_key))}
+                       for draw in draws]
+
+            db.session.execute(update(Draw), changes)
+            db.session.commit()
+
+            backfilled += len(draws)
+            last_id = draws[-1].id
+
+
+# writes the round summaries of rounds played before the round engine wrote them, from the played draws that are
+# still stored; one batch of users per commit, existing summaries are kept
+def backfill_round_summaries(batch_size=500):
+    with app.app_context():
+        backfilled = 0
+        last_id = 0
+
+        while True:
+            user_ids = [user_id for user_id, in db.session.query(User.id)
+                        .filter(User.id > last_id)
+                        .order_by(User.id)
+                        .limit(batch_size)]
+
+            if not user_ids:
+                return backfilled
+
+            # rounds played before draws recorded their matches only know whether a draw matched the master draw
+            matches = case((Draw.matches_master == True, 6), else_=Draw.matches)
+            summaries = db.session.query(Draw.user_id, Draw.lottery_round, func.count(Draw.id),
+                                         func.sum(case((matches > 0, 1), else_=0)), func.max(matches),
+                                         func.current_timestamp()) \
+                .filter(Draw.user_id.between(user_ids[0], user_ids[-1]), Draw.been_played == True,
+                        Draw.master_draw == False) \
+                .group_by(Draw.user_id, Draw.lottery_round)
+
+            backfilled += db.session.execute(insert(RoundSummary)
+                                             .from_select(['user_id', 'lottery_round', 'tickets', 'winning_lines',
+                                                           'top_matches', 'played_on'], summaries)
+                                             .on_conflict_do_nothing()).rowcount
+            db.session.commit()
+
+            last_id = user_ids[-1]
+
+
+# the draw queries of the views, the round engine and the archive, built by the same functions they use; none of them
+# may need a full table scan
+def hot_draw_queries():
+    return {
+        'view_draws': playable_draws(1),
+        'check_draws': round_summaries(1).limit(1),
+        'play_again': played_draw_ids(1, 0, 1),
+        'archive_played_draws': played_draw_ids(None, 0, 1),
+        'generate_winning_draw': winning_draw(),
+        'view_winning_draw': winning_draw(unplayed=True),
+        'run_lottery': Draw.query.filter(*UNPLAYED).limit(1),
+        'run_round count': round_tickets(),
+        'run_round candidates': round_candidates('1 2 3 4 5 6', min(app.config['LOTTERY_PRIZE_TIERS']), 0, 1).limit(1),
+        'run_round jackpot candidates': round_candidates('1 2 3 4 5 6', 6, 0, 1).limit(1),
+        'run_round chunk tickets': chunk_tickets(0, 1),
+        'view_lottery_job winners': winning_draws(1, 0, 1),
+        'purge_archive rounds': expired_rounds(1, 1),
+        'purge_archive': archived_draw_ids(1, 0, 1),
+    }
+
+
+# returns the sqlite query plan of every hot query, run with bound parameters just like the application runs them
+def explain_query_plans():
+    with app.app_context():
+        plans = {}
+        for name, query in hot_draw_queries().items():
+            compiled = query.statement.compile(db.engine)
+            parameters = compiled.construct_params()
+            rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled),
+                                                           tuple(parameters[name] for name in compiled.positiontup))
+            plans[name] = [row[-1] for row in rows]
+        return plans
+
+
+# returns the hot queries whose plan scans the whole draws or archived draws table, or the whole of one of its indexes
+def find_table_scans():
+    return [name for name, plan in explain_query_plans().items()
+            if any(step.startswith(('SCAN draws', 'SCAN archived_draws')) for step in plan)]
+
+
+# COMMANDS
+@click.command('upgrade-schema')
+def upgrade_schema_command():
+    upgrade_schema()
+    click.echo('Database schema is up to date.')
+
+
+@click.command('upgrade-draw-encryption')
+@click.option('--batch-size', default=500, show_default=True, help='Draws re-encrypted per transaction.')
+def upgrade_draw_encryption_command(batch_size):
+    upgrade_schema()
+    click.echo('%d draws upgraded to envelope encryption.' % upgrade_draw_encryption(batch_size))
+
+
+@click.command('backfill-blind-index')
+@click.option('--batch-size', default=500, show_default=True, help='Draws indexed per transaction.')
+def backfill_blind_index_command(batch_size):
+    upgrade_schema()
+    click.echo('%d draws given a blind index.' % backfill_blind_index(batch_size))
+
+
+@click.command('backfill-round-summaries')
+@click.option('--batch-size', default=500, show_default=True, help='Users summarised per transaction.')
+def backfill_round_summaries_command(batch_size):
+    upgrade_schema()
+    click.echo('%d round summaries written.' % backfill_round_summaries(batch_size))
+
+
+@click.command('archive-draws')
+@click.option('--chunk-size', type=int, help='Draws moved per transaction (default ARCHIVE_CHUNK_SIZE).')
+@click.option('--pause', type=float, help='Seconds to wait between chunks (default ARCHIVE_PAUSE).')
+def archive_draws_command(chunk_size, pause):
+    upgrade_schema()
+    with app.app_context():
+        click.echo('%d played draws archived.' % archive_played_draws(chunk_size=chunk_size, pause=pause))
+
+
+@click.command('purge-archive')
+@click.option('--rounds', type=int, help='Newest rounds to keep (default ARCHIVE_RETENTION_ROUNDS, 0 keeps all).')
+@click.option('--chunk-size', type=int, help='Draws deleted per transaction (default ARCHIVE_CHUNK_SIZE).')
+@click.option('--pause', type=float, help='Seconds to wait between chunks (default ARCHIVE_PAUSE).')
+def purge_archive_command(rounds, chunk_size, pause):
+    with app.app_context():
+        click.echo('%d archived draws purged.' % purge_archive(rounds, chunk_size, pause))
+
+
+@click.command('check-query-plans')
+def check_query_plans_command():
+    for name, plan in explain_query_plans().items():
+        click.echo('%s: %s' % (name, '; '.join(plan)))
+
+    table_scans = find_table_scans()
+    if table_scans:
+        raise click.ClickException('full table scan of draws or archived draws in: %s' % ', '.join(table_scans))
+
+
+# registered with the flask cli by app.py
+COMMANDS = (upgrade_schema_command, upgrade_draw_encryption_command, backfill_blind_index_command,
+            backfill_round_summaries_command, archive_draws_command, purge_archive_command, check_query_plans_command)
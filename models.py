@@ -1,8 +1,17 @@
 from app import db, app
+from keypool import KeyPairPool
+from hashing import HashingPool
+from metrics import timed, request_metrics
+from draw_crypto import decrypt, seal, unseal, DRAW_RSA, DRAW_ENVELOPE
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import deferred, make_transient_to_detached, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 #from cryptography.fernet import Fernet
-import pyotp, bcrypt, rsa, pickle
+import pyotp, rsa, pickle, threading, hmac, hashlib, time, multiprocessing
 
 
 '''
@@ -15,14 +24,143 @@ def decrypt(data, draw_key):
     return Fernet(draw_key).decrypt(data).decode('utf-8')
 '''
 
-def encrypt(data, public_key):
-    return rsa.encrypt(data.encode(), pickle.loads(public_key))
-
-def decrypt(data, private_key):
-    return rsa.decrypt(data, pickle.loads(private_key)).decode()
+# keyed HMAC of the sorted draw numbers, so equal draws can be found with an indexed lookup instead of decrypting
+def blind_index(numbers):
+    numbers = ' '.join(map(str, sorted(map(int, numbers.split()))))
+    return hmac.new(app.config['BLIND_INDEX_KEY'].encode(), numbers.encode(), hashlib.sha256).hexdigest()
+
+
+# bounded, thread-safe LRU cache of deserialized RSA keys, keyed by user id
+class KeyCache:
+    KINDS = ('public', 'private', 'draw')
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    # returns the deserialized key, loading the stored BLOB only on a cache miss
+    def get(self, user_id, kind, data, loader=pickle.loads):
+        if user_id is None:
+            return loader(data)
+
+        with self.lock:
+            key = self.keys.get((user_id, kind))
+            if key is not None:
+                self.keys.move_to_end((user_id, kind))
+                self.hits += 1
+                return key
+            self.misses += 1
+            generation = self.generation
+
+        key = loader(data)
+
+        with self.lock:
+            # do not store a key that was invalidated while it was being unpickled
+            if generation == self.generation:
+                self.keys[(user_id, kind)] = key
+                while len(self.keys) > self.maxsize:
+                    self.keys.popitem(last=False)
+        return key
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generation += 1
+            for kind in self.KINDS:
+                self.keys.pop((user_id, kind), None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.keys),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+key_cache = KeyCache(app.config['KEY_CACHE_SIZE'])
+
+# short-lived per-process cache of the user columns read on every authenticated request, keyed by user id
+class IdentityCache:
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.identities = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cached column values of a user, or None if missing or older than the ttl
+    def get(self, user_id):
+        with self.lock:
+            cached = self.identities.get(user_id)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, values):
+        with self.lock:
+            self.identities[user_id] = (time.monotonic(), values)
+            self.identities.move_to_end(user_id)
+            while len(self.identities) > self.maxsize:
+                self.identities.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.identities.pop(user_id, None)
+
+    # every hit is a user query the request did not have to run
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.identities),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'queries_saved_per_request': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0}
+
+
+identity_cache = IdentityCache(app.config['IDENTITY_CACHE_TTL'], app.config['IDENTITY_CACHE_SIZE'])
+
+# pre-generated key pairs for new users
+key_pool = KeyPairPool(app.config['KEY_POOL_SIZE'], app.config['KEY_POOL_LOW_WATER'], app.config['KEY_POOL_WORKERS'])
+# fill the pool at startup so the first registrations do not generate keys inline, except in multiprocessing children
+# such as the lottery round workers, which never register anyone
+if multiprocessing.parent_process() is None:
+    key_pool.start()
+password_hasher = HashingPool(app.config['HASH_WORKERS'], app.config['HASH_QUEUE_SIZE'], app.config['BCRYPT_ROUNDS'])
+
+request_metrics.register('key_cache', key_cache.stats, counters=('hits', 'misses'))
+request_metrics.register('identity_cache', identity_cache.stats, counters=('hits', 'misses'))
+request_metrics.register('key_pool', key_pool.stats, counters=('generated', 'taken', 'fallbacks'))
+request_metrics.register('password_hasher', password_hasher.stats, counters=('rejected', 'rehashed'))
+
+
+# returns a user's draw key, unwrapping it with their RSA private key only on a cache miss
+def load_draw_key(user_id, draw_key, private_key):
+    return key_cache.get(user_id, 'draw', draw_key, lambda wrapped: unwrap_key(wrapped, user_id, private_key))
+
+def unwrap_key(wrapped, user_id, private_key):
+    private_key = key_cache.get(user_id, 'private', private_key)
+    with timed('crypto'):
+        return AESGCM(rsa.decrypt(wrapped, private_key))
+
+
+# decrypts stored draw numbers in either storage format using the owner's stored keys
+def decrypt_draw(numbers, encryption_version, user_id, draw_key, private_key):
+    if encryption_version == DRAW_ENVELOPE:
+        return unseal(numbers, load_draw_key(user_id, draw_key, private_key))
+    return decrypt(numbers, key_cache.get(user_id, 'private', private_key))
 
 class User(db.Model, UserMixin):
     __tablename__ = 'users'
+    __table_args__ = (
+        # keyset pages of the admin user tables
+        db.Index('ix_users_role_id', 'role', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -40,20 +178,22 @@ class User(db.Model, UserMixin):
     role = db.Column(db.String(100), nullable=False, default='user')
 
     # Logging info
-    registered_on = db.Column(db.DateTime, nullable=False)
-    current_login = db.Column(db.DateTime, nullable=True)
+    registered_on = db.Column(db.DateTime, nullable=False, index=True)
+    current_login = db.Column(db.DateTime, nullable=True, index=True)
     ip_current = db.Column(db.String(100), nullable=True)
     last_login = db.Column(db.DateTime, nullable=True)
     ip_last = db.Column(db.String(100), nullable=True)
     successful_logins = db.Column(db.Integer, nullable=False)
 
-    # Asymmetric encryption keys
-    public_key = db.Column(db.BLOB, nullable=False)
-    private_key = db.Column(db.BLOB, nullable=False)
+    # Asymmetric encryption keys, only loaded when encryption code needs them
+    public_key = deferred(db.Column(db.BLOB, nullable=False))
+    private_key = deferred(db.Column(db.BLOB, nullable=False))
     '''
     # Symmetric encryption key
     draw_key = db.Column(db.BLOB, nullable=False, default=Fernet.generate_key())
     '''
+    # Symmetric draw key, wrapped with the user's public key (null for users registered before envelope encryption)
+    draw_key = deferred(db.Column(db.BLOB, nullable=True))
 
     # Define the relationship to Draw
     draws = db.relationship('Draw')
@@ -65,7 +205,7 @@ class User(db.Model, UserMixin):
         self.phone = phone
         self.dob = dob
         self.postcode = postcode
-        self.password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        self.set_password(password)
         self.pin_key = pyotp.random_base32()
         self.role = role
         self.registered_on = datetime.now()
@@ -75,11 +215,59 @@ class User(db.Model, UserMixin):
         self.ip_last = None
         self.successful_logins = 0
 
-        # generate unique user asymmetric keys
-        public_key, private_key = rsa.newkeys(512)
+        # take unique user asymmetric keys from the key pool (generated inline if the pool is empty)
+        public_key, private_key = key_pool.take()
         self.public_key = pickle.dumps(public_key)
         self.private_key = pickle.dumps(private_key)
 
+        # generate the user's draw key and store it wrapped with their public key
+        self.draw_key = rsa.encrypt(AESGCM.generate_key(bit_length=256), public_key)
+
+    # loads a user for flask-login, from the identity cache when possible so most requests do not query the user
+    @classmethod
+    def load_identity(cls, user_id):
+        values = identity_cache.get(user_id)
+
+        if values is None:
+            user = db.session.get(cls, user_id)
+            if user:
+                identity_cache.put(user_id, {column: getattr(user, column) for column in IDENTITY_COLUMNS})
+            return user
+
+        # rebuild the user from the cached values and attach it to the session without querying; the deferred key
+        # columns are still loaded from the database on first use
+        user = cls.__mapper__.class_manager.new_instance()
+        for column, value in values.items():
+            set_committed_value(user, column, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    # returns the user's deserialized asymmetric keys from the key cache; the key columns are only read on a miss
+    def get_public_key(self):
+        return key_cache.get(self.id, 'public', self, lambda user: pickle.loads(user.public_key))
+
+    def get_private_key(self):
+        return key_cache.get(self.id, 'private', self, lambda user: pickle.loads(user.private_key))
+
+    # returns the user's unwrapped draw key, creating one for users registered before envelope encryption
+    def get_draw_key(self):
+        return key_cache.get(self.id, 'draw', self, User.unwrap_draw_key)
+
+    def unwrap_draw_key(self):
+        if self.draw_key is None:
+            # the key is stored in its own transaction and only if the user still has none, so concurrent first uses
+            # all seal their draws with the one key that was stored
+            with db.engine.begin() as connection:
+                connection.execute(update(User)
+                                   .where(User.id == self.id, User.draw_key.is_(None))
+                                   .values(draw_key=rsa.encrypt(AESGCM.generate_key(bit_length=256),
+                                                                self.get_public_key())))
+                set_committed_value(self, 'draw_key',
+                                    connection.execute(select(User.draw_key).where(User.id == self.id)).scalar())
+        private_key = self.get_private_key()
+        with timed('crypto'):
+            return AESGCM(rsa.decrypt(self.draw_key, private_key))
+
     # returns the URI for 2FA
     def get_2fa_uri(self):
         return str(pyotp.totp.TOTP(self.pin_key).provisioning_uri(
@@ -88,7 +276,16 @@ class User(db.Model, UserMixin):
     
     # returns boolean, True if password entered correctly compared to hashed value in database; False otherwise
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode('utf-8'), self.password)
+        return password_hasher.check(password, self.password)
+
+    def set_password(self, password):
+        self.password = password_hasher.hash(password)
+
+    # rehashes a just verified password when the configured bcrypt cost has changed since it was hashed
+    def rehash_password(self, password):
+        hashed = password_hasher.rehash(password, self.password)
+        if hashed:
+            self.password = hashed
 
     # returns boolean, True if input postcode matches value in database; False otherwise
     def verify_postcode(self, postcode):
@@ -99,8 +296,55 @@ class User(db.Model, UserMixin):
         return pyotp.TOTP(self.pin_key).verify(pin)
 
 
+# drop cached keys whenever a user's keys change or the user is deleted
+@event.listens_for(User.public_key, 'set')
+@event.listens_for(User.private_key, 'set')
+@event.listens_for(User.draw_key, 'set')
+def invalidate_user_keys(target, value, oldvalue, initiator):
+    if target.id is not None:
+        key_cache.invalidate(target.id)
+
+@event.listens_for(User, 'after_delete')
+def invalidate_deleted_user_keys(mapper, connection, target):
+    key_cache.invalidate(target.id)
+    changed_identity(target)
+
+# columns kept in the identity cache: everything but the deferred key columns
+IDENTITY_COLUMNS = [column.key for column in User.__table__.columns
+                    if column.key not in ('public_key', 'private_key', 'draw_key')]
+
+# drop the cached identity whenever a user is updated (log in, password change, role change, ...) or deleted. A
+# change is only dropped once it is committed: dropped at flush, another request could cache the old row again before
+# the commit
+def changed_identity(target):
+    object_session(target).info.setdefault('changed_identities', set()).add(target.id)
+
+@event.listens_for(User, 'after_update')
+def invalidate_updated_identity(mapper, connection, target):
+    changed_identity(target)
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_identities(session):
+    # releasing a savepoint commits nothing yet
+    if session.in_nested_transaction():
+        return
+    for user_id in session.info.pop('changed_identities', ()):
+        identity_cache.invalidate(user_id)
+
+
 class Draw(db.Model):
     __tablename__ = 'draws'
+    __table_args__ = (
+        # a user's playable or played draws (view_draws, check_draws)
+        db.Index('ix_draws_user_id_been_played', 'user_id', 'been_played'),
+        # winning draws, the unplayed working set of a round and all played draws
+        # (generate_winning_draw, view_winning_draw, run_lottery, play_again)
+        db.Index('ix_draws_master_draw_been_played', 'master_draw', 'been_played'),
+        # the unplayed draws matching a jackpot's blind index, or not indexed yet (run_round with only the jackpot paid)
+        db.Index('ix_draws_unplayed_blind_index', 'master_draw', 'been_played', 'blind_index'),
+        # the winning draws of a round (view_lottery_job)
+        db.Index('ix_draws_lottery_round_matches', 'lottery_round', 'matches'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -122,24 +366,35 @@ class Draw(db.Model):
     # Lottery round that draw is used
     lottery_round = db.Column(db.Integer, nullable=False, default=0)
 
+    # Numbers matched with the master draw, recorded when the draw reaches a prize tier (0 otherwise)
+    matches = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Storage format of numbers (DRAW_RSA or DRAW_ENVELOPE)
+    encryption_version = db.Column(db.Integer, nullable=False, default=DRAW_RSA, server_default=str(DRAW_RSA))
+
+    # Blind index of numbers (null for draws created before blind indexing and not yet backfilled)
+    blind_index = db.Column(db.String(64), nullable=True)
+
 
     '''
     Commenting out Symmetric Encryption
     def __init__(self, user_id, numbers, master_draw, lottery_round, draw_key):
     '''
-    def __init__(self, user_id, numbers, master_draw, lottery_round, public_key):
+    def __init__(self, user_id, numbers, master_draw, lottery_round, draw_key):
         self.user_id = user_id
         '''
         Commenting out Symmetric Encryption
         self.numbers = encrypt(numbers, draw_key)
         '''
-        self.numbers = encrypt(numbers, public_key)
+        # numbers are sealed with the owner's draw key (envelope encryption)
+        self.numbers = seal(numbers, draw_key)
+        self.encryption_version = DRAW_ENVELOPE
+        self.blind_index = blind_index(numbers)
         self.been_played = False
         self.matches_master = False
+        self.matches = 0
         self.master_draw = master_draw
         self.lottery_round = lottery_round
-        #self.draw_key = draw_key
-        self.public_key = public_key
 
 
     '''
@@ -147,9 +402,136 @@ class Draw(db.Model):
     def view_draw(self, draw_key):
         self.numbers = decrypt(self.numbers, draw_key)
     '''
-    # decrypts draw numbers but does not save to database
-    def view_draw(self, private_key):
-        self.numbers = decrypt(self.numbers, private_key)
+    # column values of a new draw, for bulk inserts that do not go through the constructor
+    @staticmethod
+    def values(user_id, numbers, master_draw, lottery_round, draw_key):
+        return {'user_id': user_id,
+                'numbers': seal(numbers, draw_key),
+                'encryption_version': DRAW_ENVELOPE,
+                'blind_index': blind_index(numbers),
+                'been_played': False,
+                'matches_master': False,
+                'matches': 0,
+                'master_draw': master_draw,
+                'lottery_round': lottery_round}
+
+    # decrypts draw numbers with the owner's keys but does not save to database
+    def view_draw(self, owner):
+        if self.encryption_version == DRAW_ENVELOPE:
+            self.numbers = unseal(self.numbers, owner.get_draw_key())
+        else:
+            self.numbers = decrypt(self.numbers, owner.get_private_key())
+
+
+# a played user draw moved out of the draws table once its round is over, so draws only holds the current round
+class ArchivedDraw(db.Model):
+    __tablename__ = 'archived_draws'
+    __table_args__ = (
+        # sqlite reuses the ids of deleted draws, so an id is only unique within its round
+        db.PrimaryKeyConstraint('lottery_round', 'id'),
+        # the winning draws of a round (view_lottery_job) and rounds past retention (purge_archive)
+        db.Index('ix_archived_draws_lottery_round_matches', 'lottery_round', 'matches'),
+    )
+
+    # ID the draw had in the draws table
+    id = db.Column(db.Integer, autoincrement=False)
+
+    # ID of user who submitted draw
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False, index=True)
+
+    # 6 draw numbers submitted, encrypted as they were in the draws table
+    numbers = db.Column(db.String(100), nullable=False)
+    encryption_version = db.Column(db.Integer, nullable=False)
+
+    # Lottery round that draw was played in, numbers matched and whether it matched the master draw
+    lottery_round = db.Column(db.Integer, nullable=False)
+    matches = db.Column(db.Integer, nullable=False)
+    matches_master = db.Column(db.BOOLEAN, nullable=False)
+
+    archived_on = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+# a user's outcome in one lottery round, written by the round engine so results never need the draws themselves
+class RoundSummary(db.Model):
+    __tablename__ = 'round_summaries'
+
+    # ID of user and lottery round, the primary key also serves a user's rounds in order
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), primary_key=True)
+    lottery_round = db.Column(db.Integer, primary_key=True)
+
+    # Draws the user played in the round
+    tickets = db.Column(db.Integer, nullable=False, default=0)
+
+    # Draws that reached a prize tier
+    winning_lines = db.Column(db.Integer, nullable=False, default=0)
+
+    # Most numbers matched by a winning draw (0 when no draw reached a prize tier)
+    top_matches = db.Column(db.Integer, nullable=False, default=0)
+
+    played_on = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+
+# background run of a lottery round, at most one per round
+class LotteryJob(db.Model):
+    __tablename__ = 'lottery_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Lottery round played by the job, unique so a round can only be started once
+    lottery_round = db.Column(db.Integer, nullable=False, unique=True)
+
+    # ID of the winning draw the round is played against
+    winning_draw_id = db.Column(db.Integer, nullable=False)
+
+    # queued, running, finished, empty (no user draws were entered) or failed
+    status = db.Column(db.String(10), nullable=False, default='queued')
+
+    # Progress: unplayed draws in the round, draws to decrypt, draws decrypted so far and winners found so far,
+    # committed with every chunk
+    tickets = db.Column(db.Integer, nullable=False, default=0)
+    decrypted = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+
+    # Checkpoint: last unplayed user draw when the round started and last draw of the last committed chunk
+    last_id = db.Column(db.Integer, nullable=True)
+    checkpoint_id = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # SQL statements and commits used by the last run of the round
+    queries = db.Column(db.Integer, nullable=False, default=0)
+    commits = db.Column(db.Integer, nullable=False, default=0)
+
+    # JSON winners per prize tier so far
+    result = db.Column(db.Text, nullable=True)
+
+    # Error of a failed round
+    error = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    # last time the job reported progress, a queued or running job that stops reporting is treated as failed
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    # True while the job is queued or running and still reporting progress
+    def is_active(self):
+        return self.status in ('queued', 'running') and \
+            datetime.now() - self.updated_at < timedelta(seconds=app.config['LOTTERY_JOB_TIMEOUT'])
+
+    def progress(self):
+        return {'id': self.id,
+                'lottery_round': self.lottery_round,
+                'status': self.status if self.status not in ('queued', 'running') or self.is_active() else 'failed',
+                'tickets': self.tickets,
+                'decrypted': self.decrypted,
+                'processed': self.processed,
+                'winners': self.winners,
+                'queries': self.queries,
+                'commits': self.commits,
+                'elapsed': ((self.finished_at or datetime.now()) - self.started_at).total_seconds() if self.started_at else 0.0,
+                'error': self.error}
+
 
 # reset and reinitialise the database with one admin user
 def init_db():
@@ -0,0 +1,121 @@
+# IMPORTS
+import os, re, sys, threading, time
+from collections import Counter
+
+
+# profile file names: <start time in ms>-<pid>-<endpoint>-<duration in ms>ms.folded
+PROFILE_NAME = re.compile(r'^(\d+)-(\d+)-([\w.]+)-(\d+)ms\.folded$')
+
+
+# collapses a frame and its callers into a single 'caller;...;callee' line, the input format of flame graph tools
+def collapse_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+# samples the stacks of requests running longer than threshold seconds every interval seconds and writes each slow
+# request's collapsed stacks to a ring of at most max_files files in directory. Requests that finish under the threshold
+# are never sampled, they only cost a dict insert and delete
+class SlowRequestProfiler:
+
+    def __init__(self, directory, threshold, interval, max_files):
+        self.directory = directory
+        self.threshold = threshold
+        self.interval = interval
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        # thread id -> [start, endpoint, stack counts, wall clock start] of the requests in progress
+        self.requests = {}
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    # the sampler is started by the first request, so it runs in each worker process rather than in a forking parent
+    def start_sampler(self):
+        with self.lock:
+            if self.sampler is None or self.sampler.pid != os.getpid():
+                self.sampler = threading.Thread(target=self.run, name='slow-request-profiler', daemon=True)
+                self.sampler.pid = os.getpid()
+                self.sampler.start()
+
+    def start(self, endpoint):
+        if self.sampler is None or self.sampler.pid != os.getpid():
+            self.start_sampler()
+        self.requests[threading.get_ident()] = [time.perf_counter(), endpoint, None, time.time()]
+
+    # ends the current thread's request, writing its profile if it was sampled
+    def finish(self):
+        request = self.requests.pop(threading.get_ident(), None)
+        if request is None or request[2] is None:
+            return
+        # the sampler may still be adding a sample taken just before the request ended
+        with self.lock:
+            stacks = Counter(request[2])
+        self.write(request[1], request[3], time.perf_counter() - request[0], stacks)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.is_set():
+            now = time.perf_counter()
+            slow = {}
+            # sleep until the oldest request in progress crosses the threshold, no request starting later can cross it
+            # any sooner
+            wait = self.threshold
+            for thread, request in list(self.requests.items()):
+                remaining = request[0] + self.threshold - now
+                if remaining <= 0:
+                    slow[thread] = request
+                else:
+                    wait = min(wait, remaining)
+
+            if slow:
+                frames = sys._current_frames()
+                with self.lock:
+                    for thread, request in slow.items():
+                        frame = frames.get(thread)
+                        if frame is not None and thread != own:
+                            if request[2] is None:
+                                request[2] = Counter()
+                            request[2][collapse_stack(frame)] += 1
+                del frames, frame
+                wait = self.interval
+            self.stopped.wait(wait)
+
+    # writes a profile and removes the oldest profiles past max_files
+    def write(self, endpoint, started, duration, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        name = '%d-%d-%s-%dms.folded' % (started * 1000, os.getpid(), re.sub(r'[^\w.]', '_', endpoint),
+                                           duration * 1000)
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'w') as file:
+            file.writelines('%s %d\n' % (stack, count) for stack, count in stacks.most_common())
+        os.replace(path + '.tmp', path)
+
+        for old in self.profiles()[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, old['name']))
+            except FileNotFoundError:
+                pass
+
+    # profiles on disk, newest first, as dicts of name, started, pid, endpoint, duration (ms) and size (bytes)
+    def profiles(self):
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in os.listdir(self.directory):
+            match = PROFILE_NAME.match(name)
+            if match is None:
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            profiles.append({'name': name, 'started': int(match.group(1)) / 1000, 'pid': int(match.group(2)),
+                             'endpoint': match.group(3), 'duration': int(match.group(4)), 'size': size})
+        return sorted(profiles, key=lambda profile: (profile['started'], profile['name']), reverse=True)
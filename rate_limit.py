@@ -0,0 +1,71 @@
+# IMPORTS
+import sqlite3, threading, time, itertools
+from contextlib import closing
+
+
+# sliding-window rate limiter backed by a local sqlite file, so every worker process on the host shares the same
+# windows and counters. Every prune_every admits, the expired attempts of all keys are deleted, so keys that are never
+# checked again do not stay in the table
+class SlidingWindowLimiter:
+
+    def __init__(self, path, window, prune_every=1000):
+        self.path = path
+        self.window = window
+        self.prune_every = prune_every
+        self.admits = itertools.count(1)
+        self.local = threading.local()
+
+        with closing(sqlite3.connect(self.path, timeout=30)) as connection, connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS rate_limit_attempts (
+                    key TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_rate_limit_attempts_key_created ON rate_limit_attempts (key, created);
+                CREATE INDEX IF NOT EXISTS ix_rate_limit_attempts_created ON rate_limit_attempts (created);
+                CREATE TABLE IF NOT EXISTS rate_limit_counters (
+                    name TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL
+                );
+            ''')
+
+    # one connection per thread, sqlite connections cannot be shared between threads
+    def connect(self):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return self.local.connection
+
+    # records an attempt for key and returns True if fewer than limit attempts were made in the window,
+    # otherwise records nothing and returns False
+    def admit(self, key, limit):
+        now = time.time()
+        connection = self.connect()
+
+        # an immediate transaction takes the write lock first, so concurrent processes cannot both admit the last slot
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if next(self.admits) % self.prune_every == 0:
+                connection.execute('DELETE FROM rate_limit_attempts WHERE created <= ?', (now - self.window,))
+            else:
+                connection.execute('DELETE FROM rate_limit_attempts WHERE key = ? AND created <= ?',
+                                   (key, now - self.window))
+            attempts = connection.execute('SELECT COUNT(*) FROM rate_limit_attempts WHERE key = ?', (key,)).fetchone()[0]
+
+            admitted = attempts < limit
+            if admitted:
+                connection.execute('INSERT INTO rate_limit_attempts (key, created) VALUES (?, ?)', (key, now))
+            connection.execute('INSERT INTO rate_limit_counters (name, count) VALUES (?, 1) '
+                               'ON CONFLICT (name) DO UPDATE SET count = count + 1',
+                               ('admitted' if admitted else 'rejected',))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        return admitted
+
+    # admitted and rejected totals across all processes
+    def stats(self):
+        counters = dict(self.connect().execute('SELECT name, count FROM rate_limit_counters').fetchall())
+        return {'admitted': counters.get('admitted', 0), 'rejected': counters.get('rejected', 0)}
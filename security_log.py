@@ -0,0 +1,203 @@
+# IMPORTS
+import logging, logging.handlers, queue, sqlite3, threading
+from contextlib import closing
+
+# CONFIG
+# width of the time buckets security events are counted in, in seconds
+BUCKET_SECONDS = 3600
+
+
+# extra fields for a security log call, so the event is also stored as a structured record:
+# logging.warning('SECURITY - ...', ..., extra=security_event('Failed Login', email=email, ip=ip))
+def security_event(event_type, user_id=None, email=None, ip=None):
+    return {'security_event': (event_type, user_id, email, ip)}
+
+
+# indexed sqlite store of structured security events, with per-bucket counts kept up to date on insert so that
+# aggregated views never have to scan the raw events
+class SecurityEventStore:
+
+    def __init__(self, path):
+        self.path = path
+
+        with closing(self.connect()) as connection, connection:
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS security_events (
+                    id INTEGER PRIMARY KEY,
+                    created REAL NOT NULL,
+                    type TEXT NOT NULL,
+                    user_id INTEGER,
+                    email TEXT,
+                    ip TEXT
+                );
+                CREATE INDEX IF NOT EXISTS ix_security_events_type_created ON security_events (type, created);
+                CREATE INDEX IF NOT EXISTS ix_security_events_ip_created ON security_events (ip, created);
+                CREATE INDEX IF NOT EXISTS ix_security_events_created ON security_events (created);
+                CREATE TABLE IF NOT EXISTS security_event_counts (
+                    bucket INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    ip TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (bucket, type, ip)
+                ) WITHOUT ROWID;
+            ''')
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    # stores (created, type, user id, email, ip) events in one transaction
+    def add(self, connection, events):
+        with connection:
+            connection.executemany('INSERT INTO security_events (created, type, user_id, email, ip) VALUES (?, ?, ?, ?, ?)',
+                                   events)
+            connection.executemany('INSERT INTO security_event_counts (bucket, type, ip, count) VALUES (?, ?, ?, 1) '
+                                   'ON CONFLICT (bucket, type, ip) DO UPDATE SET count = count + 1',
+                                   [(int(created // BUCKET_SECONDS) * BUCKET_SECONDS, event_type, ip or '')
+                                    for created, event_type, user_id, email, ip in events])
+
+    def _query(self, sql, parameters):
+        with closing(self.connect()) as connection:
+            return connection.execute(sql, parameters).fetchall()
+
+    # event counts per type since a timestamp
+    def counts_by_type(self, since):
+        return self._query('SELECT type, SUM(count) FROM security_event_counts WHERE bucket >= ? '
+                           'GROUP BY type ORDER BY SUM(count) DESC', (since // BUCKET_SECONDS * BUCKET_SECONDS,))
+
+    # the IPs with most events of a type since a timestamp
+    def counts_by_ip(self, since, event_type, limit=20):
+        return self._query('SELECT ip, SUM(count) FROM security_event_counts WHERE bucket >= ? AND type = ? '
+                           'GROUP BY ip ORDER BY SUM(count) DESC LIMIT ?',
+                           (since // BUCKET_SECONDS * BUCKET_SECONDS, event_type, limit))
+
+    # event counts per time bucket and type since a timestamp
+    def counts_by_bucket(self, since):
+        return self._query('SELECT bucket, type, SUM(count) FROM security_event_counts WHERE bucket >= ? '
+                           'GROUP BY bucket, type ORDER BY bucket DESC, type',
+                           (since // BUCKET_SECONDS * BUCKET_SECONDS,))
+
+    # the latest events since a timestamp, optionally of one type and/or from one IP
+    def events(self, since, event_type=None, ip=None, limit=50):
+        sql = 'SELECT created, type, user_id, email, ip FROM security_events WHERE created >= ?'
+        parameters = [since]
+        if event_type:
+            sql += ' AND type = ?'
+            parameters.append(event_type)
+        if ip:
+            sql += ' AND ip = ?'
+            parameters.append(ip)
+        return self._query(sql + ' ORDER BY created DESC LIMIT ?', parameters + [limit])
+
+
+# keeps only security records; checks the unformatted message so rejected records are never formatted
+class SecurityFilter(logging.Filter):
+
+    def filter(self, record):
+        return 'SECURITY' in str(record.msg)
+
+
+# puts records on a bounded queue instead of writing them on the request thread; when the queue is full the
+# record is dropped and counted rather than blocking the request
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # emit already holds the handler lock, taken again here so the count never depends on the caller
+            with self.lock:
+                self.dropped += 1
+
+
+# background thread writing queued records to the log file, one write and flush per batch, and their structured
+# security events to the event store, one transaction per batch. Errors are counted and never stop the thread: a batch
+# that cannot be written to the log file is lost, events the store rejects (e.g. database is locked) are retried with
+# later batches, keeping at most max_pending of them
+class SecurityLogWriter(threading.Thread):
+
+    # seconds to wait before retrying pending events when no new records arrive
+    RETRY_SECONDS = 1
+
+    def __init__(self, records, path, formatter, batch_size, event_store, max_pending=10000):
+        super().__init__(name='security-log-writer', daemon=True)
+        self.records = records
+        self.path = path
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self.event_store = event_store
+        self.max_pending = max_pending
+        self.pending = []
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.store_errors = 0
+        self.events_dropped = 0
+
+    def run(self):
+        stopping = False
+
+        with open(self.path, 'a') as log_file, closing(self.event_store.connect()) as events_connection:
+            while True:
+                # wait for a record, then take whatever else is already queued; after stop() only drain the queue
+                try:
+                    batch = [self.records.get(timeout=0 if stopping else self.RETRY_SECONDS if self.pending else None)]
+                except queue.Empty:
+                    if stopping:
+                        return
+                    batch = []
+
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stopping = stopping or None in batch
+                records = [record for record in batch if record is not None]
+                if records:
+                    self.write(log_file, records)
+                    self.batches += 1
+
+                self.pending.extend((record.created, *record.security_event) for record in records
+                                    if hasattr(record, 'security_event'))
+                if self.pending:
+                    self.store(events_connection)
+
+    def write(self, log_file, records):
+        try:
+            log_file.writelines([self.formatter.format(record) + '\n' for record in records])
+            log_file.flush()
+            self.written += len(records)
+        except Exception:
+            self.write_errors += 1
+
+    # stores the pending events in one transaction; on failure keeps the newest max_pending for the next attempt
+    def store(self, events_connection):
+        try:
+            self.event_store.add(events_connection, self.pending)
+            self.pending = []
+        except Exception:
+            self.store_errors += 1
+            if len(self.pending) > self.max_pending:
+                self.events_dropped += len(self.pending) - self.max_pending
+                self.pending = self.pending[-self.max_pending:]
+
+    def stats(self):
+        return {'written': self.written,
+                'batches': self.batches,
+                'write_errors': self.write_errors,
+                'store_errors': self.store_errors,
+                'pending_events': len(self.pending),
+                'events_dropped': self.events_dropped}
+
+    # writes every record queued so far and stops the thread
+    def stop(self):
+        if self.is_alive():
+            self.records.put(None)
+            self.join()
@@ -0,0 +1,26 @@
+// JavaScript function to poll the progress of a running lottery round and reload the page once it has finished
+function pollLotteryJob() {
+
+    let element = document.getElementById("lottery-job");
+
+    // only present while a round is queued or running
+    if (element === null) {
+        return;
+    }
+
+    fetch(element.dataset.progressUrl, {credentials: "same-origin"})
+        .then(response => response.json())
+        .then(job => {
+            if (job.status !== "queued" && job.status !== "running") {
+                window.location.reload();
+                return;
+            }
+            element.textContent = "Round " + job.lottery_round + ": " + job.status + ", " + job.processed + " of " +
+                (job.decrypted || job.tickets) + " draws checked, " + job.winners + " winner(s) found, " +
+                job.elapsed.toFixed(1) + "s elapsed";
+            setTimeout(pollLotteryJob, 1000);
+        })
+        .catch(() => setTimeout(pollLotteryJob, 5000));
+}
+
+window.addEventListener("load", pollLotteryJob);
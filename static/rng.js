@@ -13,9 +13,14 @@ function luckyDip() {
         // create a cryptographically secure 32-bit unsigned integer
         randomBuffer = new Uint32Array(1);
         window.crypto.getRandomValues(randomBuffer);
-        csRandomNumber = randomBuffer[i] / (0xFFFFFFFF)
-        value = Math.floor(csRandomNumber * (max - min + 1) + min);
-            
+
+        // reject values from the incomplete final range so every number is equally likely
+        range = max - min + 1;
+        if (randomBuffer[0] >= Math.floor(0x100000000 / range) * range) {
+            continue;
+        }
+        value = randomBuffer[0] % range + min;
+
         // sets cannot contain duplicates so value is only added if it does not exist in set
         draw.add(value)
   
@@ -0,0 +1,37 @@
+# IMPORTS
+import os
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+
+import pytest
+from benchmarks.population import app, db, seed
+import migrations
+from models import Draw, ArchivedDraw
+from lottery.archive import archive_played_draws
+from sqlalchemy import update
+
+
+# a population with unplayed, played and archived draws, so every hot query runs against populated tables
+@pytest.fixture(scope='module')
+def seeded():
+    seed(20, 30)
+    with app.app_context():
+        db.session.execute(update(Draw).where(Draw.id % 3 == 0).values(been_played=True, lottery_round=1, matches=3))
+        db.session.commit()
+        archive_played_draws(pause=0)
+        db.session.execute(update(Draw).where(Draw.id % 3 == 1).values(been_played=True, lottery_round=2, matches=4))
+        db.session.commit()
+        assert ArchivedDraw.query.count()
+        db.session.remove()
+
+
+def test_hot_queries_do_not_scan_draws(seeded):
+    plans = migrations.explain_query_plans()
+    assert plans
+    assert migrations.find_table_scans() == [], plans
+
+
+def test_full_index_scan_is_reported(seeded, monkeypatch):
+    hot_draw_queries = migrations.hot_draw_queries
+    monkeypatch.setattr(migrations, 'hot_draw_queries',
+                        lambda: dict(hot_draw_queries(), been_played=Draw.query.filter_by(been_played=True)))
+    assert migrations.find_table_scans() == ['been_played']
@@ -1,12 +1,12 @@
 # IMPORTS
-from flask import Blueprint, render_template, flash, redirect, url_for, session, request
-from app import db, requires_roles
+from flask import Blueprint, render_template, flash, redirect, url_for, session, request, abort
+from app import app, db, requires_roles, security_event, login_limiter
 from models import User
 from users.forms import RegisterForm, LoginForm, PasswordForm
 from markupsafe import Markup
 from flask_login import current_user, login_user, logout_user, login_required
 from datetime import datetime
-import logging, bcrypt
+import logging
 
 # CONFIG
 users_blueprint = Blueprint('users', __name__, template_folder='templates')
@@ -50,7 +50,8 @@ def register():
 
         logging.warning('SECURITY - User Registration [%s, %s]',
                         form.email.data,
-                        request.remote_addr)
+                        request.remote_addr,
+                        extra=security_event('User Registration', email=form.email.data, ip=request.remote_addr))
         # add the new user to the database
         db.session.add(new_user)
         db.session.commit()
@@ -76,7 +77,23 @@ def login():
         if not session.get('authentication_attempts'):
             session['authentication_attempts'] = 0
 
+        # reject attempts over the per-IP limit before any form, database or password work
+        if request.method == 'POST' and not login_limiter.admit('ip:%s' % request.remote_addr,
+                                                                 app.config['LOGIN_LIMIT_PER_IP']):
+            logging.warning('SECURITY - Login Rate Limited [%s]',
+                            request.remote_addr,
+                            extra=security_event('Login Rate Limited', ip=request.remote_addr))
+            abort(429)
+
         if form.validate_on_submit():
+            # reject attempts over the per-email limit before looking up the user and checking the password
+            if not login_limiter.admit('email:%s' % form.email.data.lower(), app.config['LOGIN_LIMIT_PER_EMAIL']):
+                logging.warning('SECURITY - Login Rate Limited [%s, %s]',
+                                form.email.data,
+                                request.remote_addr,
+                                extra=security_event('Login Rate Limited', email=form.email.data, ip=request.remote_addr))
+                abort(429)
+
             user = User.query.filter_by(email=form.email.data).first()
 
             if not user or not user.verify_password(form.password.data) or not user.verify_pin(form.pin.data) or not user.verify_postcode(form.postcode.data):
@@ -84,7 +101,8 @@ def login():
                 session['authentication_attempts'] += 1
                 logging.warning('SECURITY - Failed Login [%s, %s]',
                                 form.email.data,
-                                request.remote_addr)
+                                request.remote_addr,
+                                extra=security_event('Failed Login', email=form.email.data, ip=request.remote_addr))
                 if session.get('authentication_attempts') >= 3:
                     flash(Markup('Number of incorrect login attempts exceeded. Please click <a href="/reset">here</a> to reset.'))
                     return render_template('users/login.html')
@@ -93,11 +111,13 @@ def login():
             else:
                 # successful login
                 login_user(user)
+                user.rehash_password(form.password.data)
 
                 logging.warning('SECURITY - Log In [%s, %s, %s]',
                                 current_user.id,
                                 current_user.email,
-                                request.remote_addr)
+                                request.remote_addr,
+                                extra=security_event('Log In', current_user.id, current_user.email, request.remote_addr))
                 
                 # storing information about current and last logins to the database
                 current_user.last_login = current_user.current_login
@@ -129,7 +149,8 @@ def logout():
     logging.warning('SECURITY - Log Out [%s, %s, %s]',
                                 current_user.id,
                                 current_user.email,
-                                request.remote_addr)
+                                request.remote_addr,
+                                extra=security_event('Log Out', current_user.id, current_user.email, request.remote_addr))
     
     logout_user()
     
@@ -183,7 +204,7 @@ def change_password():
 
         if current_user.verify_password(form.current_password.data):
             if not current_user.verify_password(form.new_password.data):
-                current_user.password = bcrypt.hashpw(form.new_password.data.encode('utf-8'), bcrypt.gensalt())
+                current_user.set_password(form.new_password.data)
                 db.session.commit()
                 flash('Password changed successfully')
             else: